@@ -0,0 +1,60 @@
+from itertools import islice
+from multiprocessing import Pool, cpu_count
+from os import devnull, path
+from shutil import copyfile, move, rmtree
+from tempfile import mkdtemp
+import sys
+import traceback
+
+
+def run_seed(args):
+    # runs in a fresh worker process, since tables load once per process
+    sourcefile, flags, seed, extract, output_dir, prepare = args
+    import randomizer
+    if prepare is not None:
+        prepare(randomizer)
+    tempdir = mkdtemp(prefix="smrpg_")
+    stdout = sys.stdout
+    try:
+        romfile = path.join(tempdir, path.basename(sourcefile))
+        copyfile(sourcefile, romfile)
+        sys.stdout = open(devnull, "w")
+        outfile = randomizer.randomize_rom(romfile, flags, seed)
+        sys.stdout = stdout
+        result, keep = extract(randomizer, seed)
+        if keep and output_dir is not None:
+            destination = path.join(output_dir, path.basename(outfile))
+            move(outfile, destination)
+            result = (result, destination)
+        return seed, result, None
+    except Exception:
+        sys.stdout = stdout
+        return seed, None, traceback.format_exc()
+    finally:
+        rmtree(tempdir, ignore_errors=True)
+
+
+def run_seeds(sourcefile, flags, seeds, extract, output_dir=None,
+              processes=None, prepare=None):
+    # yields (seed, result, error) in completion order. extract(randomizer,
+    # seed) runs in the worker and returns (result, keep); the rom is only
+    # kept, in output_dir, if keep is true. prepare(randomizer), if given,
+    # runs before randomizing. closing the generator stops it.
+    if processes is None:
+        processes = cpu_count()
+    pool = Pool(processes, maxtasksperchild=1)
+    seeds = iter(seeds)
+    try:
+        while True:
+            # feed the pool a window at a time so memory stays flat
+            window = list(islice(seeds, processes * 8))
+            if not window:
+                break
+            tasks = [(sourcefile, flags, seed, extract, output_dir, prepare)
+                     for seed in window]
+            for seed, result, error in pool.imap_unordered(run_seed, tasks):
+                yield seed, result, error
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
@@ -0,0 +1,326 @@
+from collections import defaultdict
+from hashlib import md5
+from os import environ, path
+from shutil import rmtree
+from subprocess import Popen, PIPE
+from tempfile import mkdtemp
+from tablespecs import (TABLES_DIR, encode_field, read_spec,
+                        read_table_list)
+from time import time
+import argparse
+import json
+import random
+import sys
+
+
+BASE_DIR = path.dirname(path.abspath(__file__))
+ROM_SIZE = 0x400000
+SYNTHETIC_SEED = 0x5eed
+SYNTHETIC_LABEL = "SMRPG_BENCH"
+FLAG_SETS = ["c", "d", "f", "m", "p", "q", "s", "z", "cdfmpqsz"]
+HISTORY_FILENAME = "benchmark_history.jsonl"
+
+# free space in the synthetic rom for animation sequences
+ANIM_SEQ_ADDRESS = 0x260000
+ANIM_SEQ_SIZE = 0x10
+
+
+def fill_monster(r, index):
+    boss = index >= 0xe0 or r.randint(1, 12) == 12
+    return {"hp": r.randint(10, 3000) * (4 if boss else 1),
+            "speed": r.randint(0, 40), "attack": r.randint(1, 150),
+            "defense": r.randint(0, 120), "magic_attack": r.randint(1, 120),
+            "magic_defense": r.randint(0, 100), "fp": r.randint(0, 99),
+            "evade": r.randint(0, 30), "magic_evade": r.randint(0, 30),
+            "misc": 1 if boss else 0,
+            "hit_special_defense": r.randint(0, 0xFF),
+            "coin_anim_entrance": r.randint(0, 0xFF)}
+
+
+def fill_formation(r, index):
+    values = {"enemies_present": 0, "enemies_hidden": 0}
+    num_enemies = 0 if index % 64 == 63 else r.randint(1, 6)
+    for i in xrange(8):
+        if i < num_enemies:
+            values["enemies_present"] |= (1 << (7-i))
+            values["monster%s" % i] = r.randint(0, 0xdf)
+            values["monster%s_x" % i] = r.randint(130, 200)
+            values["monster%s_y" % i] = r.randint(90, 150)
+        else:
+            for suffix in ["", "_x", "_y"]:
+                values["monster%s%s" % (i, suffix)] = 0
+    return values
+
+
+def item_type(index):
+    if 0x05 <= index <= 0x23:
+        return 0
+    if 0x25 <= index <= 0x46:
+        return 1
+    if 0x4a <= index <= 0x5e:
+        return 2
+    return 3
+
+
+def fill_item(r, index):
+    itemtype = item_type(index)
+    values = {"variance": r.randint(1, 5) if itemtype == 0 else 0,
+              "misc_attack": r.randint(0, 7)}
+    if itemtype < 3:
+        values["useable_itemtype"] = itemtype
+        values["equippable"] = 1 << r.choice([0, 0, 1, 2, 3, 4])
+        for attr in ["speed", "attack", "defense",
+                     "magic_attack", "magic_defense"]:
+            values[attr] = r.randint(0, 20)
+    else:
+        consumable = 0x60 <= index <= 0xb0
+        values["useable_itemtype"] = itemtype | (0x18 if consumable else 0)
+        if consumable and r.randint(1, 8) == 8:
+            values["useable_itemtype"] |= 0x20
+        values["equippable"] = 0
+        for attr in ["speed", "attack", "defense",
+                     "magic_attack", "magic_defense"]:
+            values[attr] = 0
+    return values
+
+
+def fill_shop(r, index):
+    stock = sorted(r.sample(range(0x05, 0xb0), r.randint(4, 15)))
+    if index == 12:
+        stock = sorted(r.sample(range(0x60, 0xb0), 15))
+    return {"misc": 0x03 if index in [3, 6] else 0,
+            "items": stock + [0xFF] * (15 - len(stock))}
+
+
+def fill_stat_row(r, index):
+    return {"max_hp": r.randint(0, 15),
+            "physical": (r.randint(0, 6) << 4) | r.randint(0, 6),
+            "magical": (r.randint(0, 6) << 4) | r.randint(0, 6)}
+
+
+TABLE_RULES = {
+    "EnemSpriteObject": lambda r, i: {"animation": r.randint(0, 443)},
+    "AnimSeqPTRObject": lambda r, i: {
+        "anim_seq_ptr": 0xC00000 | (ANIM_SEQ_ADDRESS + (i * ANIM_SEQ_SIZE))},
+    "MonsterObject": fill_monster,
+    "MonsterAttackObject": lambda r, i: {
+        "misc_multiplier": r.randint(0, 8), "hitrate": r.randint(50, 100),
+        "ailments": 1 << r.randint(0, 6) if r.randint(1, 4) == 4 else 0,
+        "buffs": 0},
+    "MonsterRewardObject": lambda r, i: {
+        "xp": r.randint(1, 500), "coins": r.randint(0, 50),
+        "yoshi_cookie": 0xFF, "drop": r.randint(0x60, 0xb0),
+        "rare_drop": r.randint(0x60, 0xb0)},
+    "PackObject": lambda r, i: {
+        "formation_ids": [r.randint(0, 0xFF) for _ in xrange(3)],
+        "misc": 7 if i % 31 == 30 else 0},
+    "MonsterNameObject": lambda r, i: {"name": "MONSTER %0.3x" % i},
+    "FormationObject": fill_formation,
+    "FormMetaObject": lambda r, i: {
+        "bowser_intro": 0, "event": 0xFF,
+        "misc": r.randint(0, 7) << 2},
+    "CharacterObject": lambda r, i: {
+        "level": r.randint(1, 6), "max_hp": r.randint(20, 60),
+        "current_hp": 20, "speed": r.randint(10, 30),
+        "attack": r.randint(10, 30), "defense": r.randint(5, 25),
+        "magic_attack": r.randint(5, 25), "magic_defense": r.randint(5, 25),
+        "xp": 0, "weapon": 0xFF, "armor": 0xFF, "accessory": 0xFF,
+        "known_spells": 0},
+    "ItemObject": fill_item,
+    "PriceObject": lambda r, i: {
+        "price": 0 if item_type(i) == 3 and not 0x60 <= i <= 0xb0
+        else r.randint(2, 300)},
+    "SpellNameObject": lambda r, i: {"name": "SPELL %0.3x" % i},
+    "LevelUpXPObject": lambda r, i: {"xp": 20 + (i * i * 30)},
+    "StatGrowthObject": fill_stat_row,
+    "StatBonusObject": fill_stat_row,
+    "SpellObject": lambda r, i: {
+        "fp": r.randint(1, 30), "power": r.randint(0, 100),
+        "hitrate": r.randint(50, 100)},
+    "LearnObject": lambda r, i: {
+        "spell": r.randint(0, 0x1a) if r.randint(1, 6) == 6 else 0xFF},
+    "ShopObject": fill_shop,
+    "ItemNameObject": lambda r, i: {"name": "ITEM %0.3x" % i},
+    }
+
+
+def encode_record(r, objname, index, spec):
+    values = TABLE_RULES.get(objname, lambda r, i: {})(r, index)
+    data = ""
+    for name, size, fieldtype in spec:
+        if name in values:
+            value = values[name]
+        elif fieldtype == "str":
+            value = "%s %s" % (objname, index)
+        elif fieldtype == "list":
+            value = [r.randint(0, 0xFF) for _ in xrange(size)]
+        else:
+            value = r.randint(0, (1 << (8*size)) - 1)
+        data += encode_field(value, size, fieldtype)
+    return data
+
+
+def build_synthetic_rom(filename):
+    r = random.Random(SYNTHETIC_SEED)
+    rom = bytearray(ROM_SIZE)
+    for n in xrange(444):
+        # the randomizer reads vram usage from offset 8 of each sequence
+        rom[ANIM_SEQ_ADDRESS + (n * ANIM_SEQ_SIZE) + 8] = r.randint(2, 16)
+    for table in read_table_list():
+        spec = read_spec(table["tablefile"])
+        records = [encode_record(r, table["objname"], i, spec)
+                   for i in xrange(table["count"])]
+        address = table["address"]
+        if table["grouped"] and table["grouped"][0] == "point1":
+            # pointer table first, records right after it
+            _, base, pointer_size = table["grouped"]
+            pointer = address + (table["count"] * pointer_size)
+            for i, record in enumerate(records):
+                offset = (pointer - base) & ((1 << (8*pointer_size)) - 1)
+                rom[address + (i*pointer_size):
+                    address + ((i+1)*pointer_size)] = encode_field(
+                        offset, pointer_size, "int")
+                rom[pointer:pointer+len(record)] = record
+                pointer += len(record)
+        else:
+            data = "".join(records)
+            rom[address:address+len(data)] = data
+    f = open(filename, "wb")
+    f.write(rom)
+    f.close()
+    return md5(rom).hexdigest()
+
+
+def check_registered(rom_md5):
+    for line in open(path.join(TABLES_DIR, "master.txt")):
+        parts = line.split()
+        if parts and parts[0] == SYNTHETIC_LABEL:
+            if parts[1] != rom_md5:
+                raise Exception("The synthetic rom hash is %s, but "
+                                "tables/master.txt has %s." % (
+                                    rom_md5, parts[1]))
+            return
+    raise Exception("%s is missing from tables/master.txt." % SYNTHETIC_LABEL)
+
+
+def check_randomtools():
+    # every run would fail the same way, so fail once, before building
+    if not path.exists(path.join(BASE_DIR, "randomtools", "tablereader.py")):
+        raise Exception("The randomtools submodule is missing; run \"git "
+                        "submodule update --init\" first.")
+
+
+def run_seed(romfile, flags, seed):
+    report_filename = path.join(path.dirname(romfile),
+                                "profile.%s.%s.json" % (flags, seed))
+    env = dict(environ)
+    env["SMRPG_PROFILE"] = report_filename
+    start = time()
+    p = Popen([sys.executable, path.join(BASE_DIR, "randomizer.py"),
+               romfile, flags, str(seed)], cwd=BASE_DIR, env=env,
+              stdin=PIPE, stdout=PIPE, stderr=PIPE)
+    out, err = p.communicate("\n" * 10)
+    wall = time() - start
+    if not path.exists(report_filename) or "ERROR" in out:
+        raise Exception("Randomizer failed with flags %s: %s" % (
+            flags, (out + err).strip().splitlines()[-1:]))
+    report = json.load(open(report_filename))
+    phases = defaultdict(float)
+    for phase in report["phases"]:
+        phases["%s.%s" % (phase["class"], phase["phase"])] += phase["wall"]
+    return {"wall": wall, "phases": dict(phases),
+            "counters": report["counters"],
+            "peak_memory": report["peak_memory"]}
+
+
+def median(values):
+    values = sorted(values)
+    if not values:
+        return None
+    mid = len(values) / 2
+    if len(values) % 2:
+        return values[mid]
+    return (values[mid-1] + values[mid]) / 2.0
+
+
+def load_history(filename):
+    if not path.exists(filename):
+        return []
+    return [json.loads(line) for line in open(filename) if line.strip()]
+
+
+def find_regressions(result, history, threshold, min_delta, window):
+    regressions = []
+    previous = [h for h in history if h["flags"] == result["flags"]
+                and h["rom_md5"] == result["rom_md5"]][-window:]
+    if not previous:
+        return regressions
+    keys = [("wall", lambda h: h["wall"])]
+    for phase in sorted(result["phases"]):
+        keys.append((phase, lambda h, phase=phase: h["phases"].get(phase)))
+    for key, getter in keys:
+        baseline = median([getter(h) for h in previous
+                           if getter(h) is not None])
+        current = getter(result)
+        if baseline is None or current is None:
+            continue
+        if current > baseline * threshold and current - baseline > min_delta:
+            regressions.append((key, baseline, current))
+    return regressions
+
+
+def run_benchmarks(flag_sets, seeds, history_filename, threshold,
+                   min_delta, window):
+    check_randomtools()
+    tempdir = mkdtemp(prefix="smrpg_bench_")
+    try:
+        romfile = path.join(tempdir, "synthetic.smc")
+        rom_md5 = build_synthetic_rom(romfile)
+        check_registered(rom_md5)
+        history = load_history(history_filename)
+        failed = False
+        for flags in flag_sets:
+            runs = [run_seed(romfile, flags, seed) for seed in seeds]
+            phases = defaultdict(list)
+            for run in runs:
+                for key, value in run["phases"].items():
+                    phases[key].append(value)
+            result = {
+                "flags": flags, "rom_md5": rom_md5, "time": time(),
+                "seeds": seeds, "wall": median([r["wall"] for r in runs]),
+                "phases": dict([(k, median(v)) for (k, v) in phases.items()]),
+                "peak_memory": max([r["peak_memory"] for r in runs]),
+                }
+            regressions = find_regressions(result, history, threshold,
+                                           min_delta, window)
+            print "%-10s %8.3fs" % (flags, result["wall"])
+            for key, baseline, current in regressions:
+                failed = True
+                print "    REGRESSION %s: %.3fs -> %.3fs" % (
+                    key, baseline, current)
+            f = open(history_filename, "a")
+            f.write(json.dumps(result, sort_keys=True) + "\n")
+            f.close()
+        return not failed
+    finally:
+        rmtree(tempdir)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Benchmark the randomizer against a synthetic rom.")
+    parser.add_argument("--flags", nargs="*", default=FLAG_SETS)
+    parser.add_argument("--seeds", nargs="*", type=int, default=[1, 2, 3])
+    parser.add_argument("--history", default=HISTORY_FILENAME)
+    parser.add_argument("--threshold", type=float, default=1.25)
+    parser.add_argument("--min-delta", type=float, default=0.05)
+    parser.add_argument("--window", type=int, default=5)
+    parser.add_argument("--build-rom", metavar="FILENAME",
+                        help="only write the synthetic rom and its md5")
+    args = parser.parse_args()
+    if args.build_rom:
+        print build_synthetic_rom(args.build_rom)
+        sys.exit(0)
+    ok = run_benchmarks(args.flags, args.seeds, args.history, args.threshold,
+                        args.min_delta, args.window)
+    sys.exit(0 if ok else 1)
@@ -0,0 +1,162 @@
+from batch import run_seeds
+from os import path
+import argparse
+import sqlite3
+import sys
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS seeds (
+    seed INTEGER, flags TEXT, version INTEGER,
+    PRIMARY KEY (seed, flags));
+CREATE TABLE IF NOT EXISTS items (
+    item INTEGER PRIMARY KEY, name TEXT);
+CREATE TABLE IF NOT EXISTS monsters (
+    monster INTEGER PRIMARY KEY, name TEXT);
+CREATE TABLE IF NOT EXISTS shops (
+    seed INTEGER, flags TEXT, shop INTEGER, slot INTEGER, item INTEGER,
+    price INTEGER, frog_coins INTEGER);
+CREATE TABLE IF NOT EXISTS drops (
+    seed INTEGER, flags TEXT, monster INTEGER, drop_item INTEGER,
+    rare_drop INTEGER, yoshi_cookie INTEGER, xp INTEGER, coins INTEGER);
+CREATE TABLE IF NOT EXISTS pack_formations (
+    seed INTEGER, flags TEXT, pack INTEGER, slot INTEGER,
+    formation INTEGER, rank INTEGER);
+CREATE TABLE IF NOT EXISTS formation_enemies (
+    seed INTEGER, flags TEXT, formation INTEGER, slot INTEGER,
+    monster INTEGER);
+CREATE TABLE IF NOT EXISTS learnsets (
+    seed INTEGER, flags TEXT, character INTEGER, level INTEGER,
+    spell INTEGER);
+CREATE TABLE IF NOT EXISTS growth (
+    seed INTEGER, flags TEXT, character INTEGER, level INTEGER,
+    max_hp INTEGER, attack INTEGER, defense INTEGER, magic_attack INTEGER,
+    magic_defense INTEGER);
+CREATE INDEX IF NOT EXISTS shops_item ON shops (item, seed);
+CREATE INDEX IF NOT EXISTS shops_seed ON shops (seed, flags, shop);
+CREATE INDEX IF NOT EXISTS drops_item ON drops (drop_item, seed);
+CREATE INDEX IF NOT EXISTS drops_rare ON drops (rare_drop, seed);
+CREATE INDEX IF NOT EXISTS drops_cookie ON drops (yoshi_cookie, seed);
+CREATE INDEX IF NOT EXISTS drops_seed ON drops (seed, flags, monster);
+CREATE INDEX IF NOT EXISTS packs_seed ON pack_formations (seed, flags, pack);
+CREATE INDEX IF NOT EXISTS enemies_monster
+    ON formation_enemies (monster, seed);
+CREATE INDEX IF NOT EXISTS enemies_seed
+    ON formation_enemies (seed, flags, formation);
+CREATE INDEX IF NOT EXISTS learnsets_spell ON learnsets (spell, character);
+CREATE INDEX IF NOT EXISTS growth_seed ON growth (seed, flags, character);
+"""
+
+
+def extract_rows(randomizer, seed):
+    r = randomizer
+    rows = {"items": [], "monsters": [], "shops": [], "drops": [],
+            "pack_formations": [], "formation_enemies": [],
+            "learnsets": [], "growth": []}
+    for i in r.ItemObject.every:
+        rows["items"].append((i.index, i.name))
+    for m in r.MonsterObject.every:
+        rows["monsters"].append((m.index, m.name))
+    for p in r.ShopObject.every:
+        for slot, i in enumerate(p.items):
+            if i != 0xFF:
+                rows["shops"].append((p.index, slot, i,
+                                      r.PriceObject.get(i).price,
+                                      int(bool(p.uses_frog_coins))))
+    for m in r.MonsterRewardObject.every:
+        rows["drops"].append((m.index, m.drop, m.rare_drop, m.yoshi_cookie,
+                              m.xp, m.coins))
+    formations = set([])
+    for p in r.PackObject.every:
+        for slot, f in enumerate(p.formations):
+            rows["pack_formations"].append((p.index, slot, f.index, f.rank))
+            formations.add(f)
+    for f in sorted(formations, key=lambda f: f.index):
+        for slot, e in enumerate(f.enemies):
+            rows["formation_enemies"].append((f.index, slot, e.index))
+    for c in r.CharacterObject.every:
+        learned = [l for l in r.LearnObject.get_character_rows(c.index)
+                   if l.spell != 0xFF]
+        # spells learned later are only listed at the level they're learned
+        later = set([l.spell for l in learned])
+        for spell in xrange(0x1b):
+            if c.known_spells & (1 << spell) and spell not in later:
+                rows["learnsets"].append((c.index, 1, spell))
+        for l in learned:
+            rows["learnsets"].append((c.index, l.level, l.spell))
+        for level in xrange(c.level, 31):
+            rows["growth"].append(tuple(
+                [c.index, level] + [c.get_stat_at_level(attr, level)
+                                    for attr in r.LEVEL_STATS]))
+    return (r.VERSION, rows), False
+
+
+def insert_seed(cursor, seed, flags, version, rows):
+    cursor.execute("INSERT OR REPLACE INTO seeds VALUES (?, ?, ?)",
+                   (seed, flags, version))
+    cursor.executemany("INSERT OR IGNORE INTO items VALUES (?, ?)",
+                       rows.pop("items"))
+    cursor.executemany("INSERT OR IGNORE INTO monsters VALUES (?, ?)",
+                       rows.pop("monsters"))
+    for table, values in rows.items():
+        # a rerun with no rows must still clear the previous rows
+        cursor.execute("DELETE FROM %s WHERE seed = ? AND flags = ?" % table,
+                       (seed, flags))
+        if not values:
+            continue
+        marks = ", ".join(["?"] * (len(values[0]) + 2))
+        cursor.executemany("INSERT INTO %s VALUES (%s)" % (table, marks),
+                           [(seed, flags) + v for v in values])
+
+
+def build_catalog(database, sourcefile, flags, seeds, batch_size=100,
+                  processes=None):
+    connection = sqlite3.connect(database)
+    connection.executescript(SCHEMA)
+    cursor = connection.cursor()
+    pending = 0
+    try:
+        for seed, result, error in run_seeds(sourcefile, flags, seeds,
+                                             extract_rows,
+                                             processes=processes):
+            if error is not None:
+                print >>sys.stderr, "Seed %s failed:\n%s" % (seed, error)
+                continue
+            version, rows = result
+            insert_seed(cursor, seed, flags, version, rows)
+            pending += 1
+            if pending >= batch_size:
+                # one transaction per batch of seeds
+                connection.commit()
+                pending = 0
+        connection.commit()
+    finally:
+        connection.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Store the key tables of many seeds in a SQLite "
+                    "database, or query one.")
+    subparsers = parser.add_subparsers(dest="command")
+    build = subparsers.add_parser("build")
+    build.add_argument("database")
+    build.add_argument("sourcefile")
+    build.add_argument("flags")
+    build.add_argument("--start", type=int, default=0)
+    build.add_argument("--count", type=int, default=1000)
+    build.add_argument("--batch-size", type=int, default=100)
+    build.add_argument("--processes", type=int, default=None)
+    query = subparsers.add_parser("query")
+    query.add_argument("database")
+    query.add_argument("sql")
+    args = parser.parse_args()
+    if args.command == "build":
+        build_catalog(args.database, path.abspath(args.sourcefile),
+                      args.flags, xrange(args.start, args.start + args.count),
+                      batch_size=args.batch_size, processes=args.processes)
+    else:
+        connection = sqlite3.connect(args.database)
+        for row in connection.execute(args.sql):
+            print "\t".join([str(v) for v in row])
+        connection.close()
@@ -0,0 +1,193 @@
+from batch import run_seeds
+from functools import partial
+from os import path
+import argparse
+import json
+import sys
+
+
+# a rough model, meant for comparing seeds rather than predicting battles:
+# the party fights every pack once in index order, shares the xp of each
+# pack's first formation, and buys the best gear from the shops whose index
+# is proportional to how far along the packs it is. the tables don't say
+# where shops are, so shop index standing in for progress is a heuristic;
+# the juice bar menus only sell drinks and are left out. damage is the
+# difference of attack and defense, and monsters hit with the mean
+# multiplier of the damaging monster attacks.
+MODEL = "heuristic: packs and shops open in index order"
+PARTY_SIZE = 3
+MAX_LEVEL = 30
+SLOTS = ["is_weapon", "is_armor", "is_accessory"]
+STATS = ["max_hp", "attack", "defense", "magic_attack", "magic_defense"]
+
+
+def signed(value):
+    return value - 256 if value & 0x80 else value
+
+
+def get_attack_factor(r):
+    multipliers = [a.multiplier for a in r.MonsterAttackObject.every
+                   if not a.no_damage]
+    if not multipliers:
+        return 1.0
+    return 1.0 + (sum(multipliers) / float(len(multipliers)) / 8)
+
+
+def get_formation_stats(r, formation, attack_factor):
+    # per enemy: (hp, attack, defense, magic attack, magic defense,
+    # magic factor) with element resistances weakening the party's magic
+    stats = []
+    for m in formation.enemies:
+        resisted = bin(m.resistances >> 4).count("1")
+        stats.append((max(m.hp, 1), m.attack * attack_factor, m.defense,
+                      m.magic_attack * attack_factor, m.magic_defense,
+                      1 - (resisted / 8.0)))
+    return stats
+
+
+def get_gear(r, shops):
+    # character -> stat -> total bonus of the best item in each slot
+    items = set([i for s in shops for i in s.items if i != 0xFF])
+    items = [r.ItemObject.get(i) for i in sorted(items)]
+    gear = []
+    for c in xrange(5):
+        bonus = dict([(attr, 0) for attr in STATS])
+        for slot in SLOTS:
+            candidates = [i for i in items if getattr(i, slot)
+                          and i.equippable & (1 << c)]
+            if not candidates:
+                continue
+            best = max(candidates, key=lambda i: (i.stat_point_value,
+                                                  i.index))
+            for attr in STATS[1:]:
+                bonus[attr] += signed(getattr(best, attr))
+        gear.append(bonus)
+    return gear
+
+
+def get_party_curves(r):
+    # level -> character -> stat, for every level up to the cap
+    characters = r.CharacterObject.every
+    return [[dict([(attr, c.get_stat_at_level(attr, level))
+                   for attr in STATS]) for c in characters]
+            for level in xrange(MAX_LEVEL + 1)]
+
+
+def get_party(stats, gear):
+    party = [dict([(attr, s[attr] + g[attr]) for attr in STATS])
+             for (s, g) in zip(stats, gear)]
+    # the strongest members fight
+    return sorted(party, key=lambda c: c["attack"] + c["max_hp"],
+                  reverse=True)[:PARTY_SIZE]
+
+
+def get_levels(r):
+    # the level reached after each pack, fighting them in order
+    thresholds = [l.xp for l in r.LevelUpXPObject.every]
+    start = max([c.level for c in r.CharacterObject.every])
+    levels, xp = [], 0
+    for p in r.PackObject.every:
+        xp += sum([r.MonsterRewardObject.get(e.index).xp
+                   for e in p.formations[0].enemies])
+        level = start
+        # row n of the xp table is the total needed for level n + 2
+        while level - 1 < len(thresholds) and xp >= thresholds[level - 1]:
+            level += 1
+        levels.append(min(level, MAX_LEVEL))
+    return levels
+
+
+def score_formation(enemies, party):
+    # turns for the party to win divided by turns for it to lose;
+    # above 1 the party is expected to lose
+    if not enemies:
+        return 0.0
+    party_hp = sum([c["max_hp"] for c in party])
+    turns_to_win = 0.0
+    for hp, _, defense, _, magic_defense, magic_factor in enemies:
+        damage = sum([max(c["attack"] - defense,
+                          (c["magic_attack"] - magic_defense) * magic_factor,
+                          1) for c in party])
+        turns_to_win += hp / float(damage)
+    defense = sum([c["defense"] for c in party]) / float(len(party))
+    magic_defense = (sum([c["magic_defense"] for c in party])
+                     / float(len(party)))
+    taken = sum([max(attack - defense, magic_attack - magic_defense, 1)
+                 for (_, attack, _, magic_attack, _, _) in enemies])
+    turns_to_lose = party_hp / taken
+    return turns_to_win / turns_to_lose
+
+
+def estimate(r):
+    attack_factor = get_attack_factor(r)
+    curves = get_party_curves(r)
+    shops = sorted([s for s in r.ShopObject.every
+                    if not (s.uses_frog_coins or s.is_juice_bar)],
+                   key=lambda s: s.index)
+    packs = r.PackObject.every
+    formations = {}
+    parties = {}
+    scores = []
+    for n, p in enumerate(packs):
+        num_shops = max(1, (len(shops) * (n + 1)) / len(packs))
+        if num_shops not in parties:
+            # gear only changes when another shop opens
+            gear = get_gear(r, shops[:num_shops])
+            parties[num_shops] = [get_party(stats, gear) for stats in curves]
+        row = []
+        for party in parties[num_shops]:
+            worst = 0.0
+            for f in p.formations:
+                if f.index not in formations:
+                    formations[f.index] = get_formation_stats(
+                        r, f, attack_factor)
+                worst = max(worst, score_formation(formations[f.index],
+                                                   party))
+            row.append(worst)
+        scores.append(row)
+    levels = get_levels(r)
+    expected = [scores[n][level] for (n, level) in enumerate(levels)]
+    return {"scores": scores, "levels": levels, "expected": expected,
+            "model": MODEL}
+
+
+def extract_difficulty(max_score, randomizer, seed):
+    result = estimate(randomizer)
+    hardest = max(result["expected"])
+    keep = max_score is None or hardest <= max_score
+    return {"hardest": hardest, "expected": result["expected"],
+            "levels": result["levels"]}, keep
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Estimate how hard every pack is for the expected party "
+                    "and reject seeds where any pack is too hard.")
+    parser.add_argument("sourcefile")
+    parser.add_argument("flags")
+    parser.add_argument("--start", type=int, default=0)
+    parser.add_argument("--count", type=int, default=100)
+    parser.add_argument("--max-score", type=float, default=None,
+                        help="reject seeds with a pack scoring above this")
+    parser.add_argument("--processes", type=int, default=None)
+    parser.add_argument("--output-dir", default=None,
+                        help="keep the roms of accepted seeds here")
+    args = parser.parse_args()
+    if args.output_dir is not None:
+        args.output_dir = path.abspath(args.output_dir)
+    extract = partial(extract_difficulty, args.max_score)
+    for seed, result, error in run_seeds(
+            path.abspath(args.sourcefile), args.flags,
+            xrange(args.start, args.start + args.count), extract,
+            output_dir=args.output_dir, processes=args.processes):
+        if error is not None:
+            print >>sys.stderr, "Seed %s failed:\n%s" % (seed, error)
+            continue
+        if args.output_dir is not None and isinstance(result, tuple):
+            result = result[0]
+        accepted = (args.max_score is None
+                    or result["hardest"] <= args.max_score)
+        print json.dumps({"seed": seed, "hardest": result["hardest"],
+                          "accepted": accepted, "model": MODEL},
+                         sort_keys=True)
+        sys.stdout.flush()
@@ -0,0 +1,69 @@
+from hashlib import md5
+from tablespecs import encode_field, get_specs
+from text import decode
+
+
+DIGESTS = None
+
+
+def encode_object(o, spec):
+    return "".join([encode_field(getattr(o, name), size, fieldtype)
+                    for (name, size, fieldtype) in spec])
+
+
+def get_digests(objects, label):
+    specs = get_specs(label)
+    digests = {}
+    for cls in objects:
+        if cls.__name__ not in specs:
+            continue
+        spec = specs[cls.__name__]
+        h = md5()
+        for o in cls.every:
+            h.update(encode_object(o, spec))
+        digests[cls.__name__] = h.hexdigest()
+    return digests
+
+
+def get_rows(cls, label):
+    # field values by row, with names decoded so they can be compared
+    # and printed
+    spec = get_specs(label)[cls.__name__]
+    rows = []
+    for o in cls.every:
+        row = []
+        for name, size, fieldtype in spec:
+            value = getattr(o, name)
+            if fieldtype == "str":
+                value = decode(value, label)
+            elif fieldtype == "list":
+                value = list(value)
+            row.append(value)
+        rows.append(row)
+    return [name for (name, _, _) in spec], rows
+
+
+def diff_rows(fields, old, new):
+    # (index, field, old value, new value) for every field that differs
+    diffs = []
+    for index, (a, b) in enumerate(zip(old, new)):
+        if a == b:
+            continue
+        for name, x, y in zip(fields, a, b):
+            if x != y:
+                diffs.append((index, name, x, y))
+    for index in xrange(len(new), len(old)):
+        diffs.append((index, None, old[index], None))
+    for index in xrange(len(old), len(new)):
+        diffs.append((index, None, None, new[index]))
+    return diffs
+
+
+def enable_digests():
+    global DIGESTS
+    DIGESTS = {}
+
+
+def record_digests(phase, objects, label):
+    if DIGESTS is not None:
+        DIGESTS[phase] = get_digests(objects, label)
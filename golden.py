@@ -0,0 +1,145 @@
+from batch import run_seeds
+from functools import partial
+from hashlib import md5
+from os import path
+import argparse
+import digest
+import gzip
+import json
+import sys
+
+
+def prepare(randomizer):
+    digest.enable_digests()
+
+
+def get_objects(randomizer, names):
+    return [o for o in randomizer.get_all_objects() if o.__name__ in names]
+
+
+def extract_golden(randomizer, seed):
+    label = randomizer.get_global_label()
+    rows = dict([(o.__name__, digest.get_rows(o, label))
+                 for o in get_objects(randomizer, digest.DIGESTS["write"])])
+    return {"digests": digest.DIGESTS, "rows": rows}, False
+
+
+def extract_changed(golden, randomizer, seed):
+    # only the classes whose final digest moved are sent back
+    label = randomizer.get_global_label()
+    expected = golden[seed]["write"]
+    changed = [name for (name, value) in digest.DIGESTS["write"].items()
+               if expected.get(name) != value]
+    rows = dict([(o.__name__, digest.get_rows(o, label))
+                 for o in get_objects(randomizer, changed)])
+    return {"digests": digest.DIGESTS, "rows": rows}, False
+
+
+def get_rom_md5(filename):
+    return md5(open(filename, "rb").read()).hexdigest()
+
+
+def record(sourcefile, corpus, flag_sets, seeds, processes=None):
+    f = gzip.open(corpus, "wb")
+    failed = False
+    try:
+        rom_md5 = get_rom_md5(sourcefile)
+        for flags in flag_sets:
+            for seed, result, error in run_seeds(
+                    sourcefile, flags, seeds, extract_golden,
+                    processes=processes, prepare=prepare):
+                if error is not None:
+                    failed = True
+                    print >>sys.stderr, "Seed %s failed:\n%s" % (seed, error)
+                    continue
+                result.update({"flags": flags, "seed": seed,
+                               "rom_md5": rom_md5})
+                f.write(json.dumps(result, sort_keys=True) + "\n")
+    finally:
+        f.close()
+    return not failed
+
+
+def load_corpus(corpus):
+    entries = {}
+    for line in gzip.open(corpus, "rb"):
+        if line.strip():
+            entry = json.loads(line)
+            entries.setdefault(entry["flags"], {})[entry["seed"]] = entry
+    return entries
+
+
+def compare_phases(expected, actual):
+    # phase -> classes whose digests differ
+    diverged = {}
+    for phase in sorted(set(expected) | set(actual)):
+        a, b = expected.get(phase, {}), actual.get(phase, {})
+        names = [n for n in sorted(set(a) | set(b)) if a.get(n) != b.get(n)]
+        if names:
+            diverged[phase] = names
+    return diverged
+
+
+def check(sourcefile, corpus, processes=None, max_diffs=20):
+    entries = load_corpus(corpus)
+    rom_md5 = get_rom_md5(sourcefile)
+    passed = True
+    for flags, golden in sorted(entries.items()):
+        if any([e["rom_md5"] != rom_md5 for e in golden.values()]):
+            print >>sys.stderr, ("Warning: %s was recorded with a "
+                                 "different rom." % corpus)
+        digests = dict([(seed, e["digests"]) for (seed, e) in golden.items()])
+        extract = partial(extract_changed, digests)
+        for seed, result, error in run_seeds(
+                sourcefile, flags, sorted(golden), extract,
+                processes=processes, prepare=prepare):
+            if error is not None:
+                passed = False
+                print "%s %s: FAILED\n%s" % (flags, seed, error)
+                continue
+            diverged = compare_phases(golden[seed]["digests"],
+                                      result["digests"])
+            if not diverged:
+                continue
+            passed = False
+            print "%s %s:" % (flags, seed)
+            for phase, names in sorted(diverged.items()):
+                print "    %s: %s" % (phase, " ".join(names))
+            for name, (fields, rows) in sorted(result["rows"].items()):
+                if name not in golden[seed]["rows"]:
+                    continue
+                _, expected = golden[seed]["rows"][name]
+                diffs = digest.diff_rows(fields, expected, rows)
+                for index, field, old, new in diffs[:max_diffs]:
+                    print "    %s %x %s: %s -> %s" % (name, index, field,
+                                                      old, new)
+                if len(diffs) > max_diffs:
+                    print "    %s: %s more" % (name, len(diffs) - max_diffs)
+    return passed
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Record the tables of a corpus of golden seeds, or check "
+                    "that the randomizer still produces them.")
+    subparsers = parser.add_subparsers(dest="command")
+    rec = subparsers.add_parser("record")
+    rec.add_argument("sourcefile")
+    rec.add_argument("corpus")
+    rec.add_argument("--flags", nargs="+", required=True)
+    rec.add_argument("--seeds", nargs="+", type=int, required=True)
+    rec.add_argument("--processes", type=int, default=None)
+    chk = subparsers.add_parser("check")
+    chk.add_argument("sourcefile")
+    chk.add_argument("corpus")
+    chk.add_argument("--processes", type=int, default=None)
+    chk.add_argument("--max-diffs", type=int, default=20)
+    args = parser.parse_args()
+    sourcefile = path.abspath(args.sourcefile)
+    if args.command == "record":
+        ok = record(sourcefile, args.corpus, args.flags, args.seeds,
+                    processes=args.processes)
+    else:
+        ok = check(sourcefile, args.corpus, processes=args.processes,
+                   max_diffs=args.max_diffs)
+    sys.exit(0 if ok else 1)
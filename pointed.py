@@ -0,0 +1,168 @@
+from hashlib import md5
+from mmap import mmap, ACCESS_READ
+from profiling import count_event
+from snapshot import get_label
+from text import decode
+import argparse
+
+
+# name: (pointer table, count, bank, end of the last record or None,
+#        terminator of the last record or None)
+POINTED_TABLES = {
+    "SMRPG_NA": {
+        # a battle script has a main and a counter section, each ending in
+        # ff, so the last script is bounded by the monster names after it
+        "monster_ai": (0x3930aa, 256, 0x390000, 0x3992d1, None),
+        "psychopath": (0x399fd1, 256, 0x390000, None, "\x00"),
+        },
+    }
+
+
+class PointedTable(object):
+    # a table of 2 byte pointers to variable length records. only the
+    # offsets are read up front; records are read from the mapped rom the
+    # first time they are accessed, and nothing is written unless one changed.
+    # each record ends where the next one starts, and the last one at end,
+    # or else after its terminator
+    def __init__(self, filename, address, count, base, end=None,
+                 terminator=None, decode=None, encode=None):
+        if (end is None) == (terminator is None):
+            raise Exception("A pointed table needs an end or a terminator.")
+        self.filename = filename
+        self.address, self.count, self.base = address, count, base
+        self.end, self.terminator = end, terminator
+        self.decode, self.encode = decode, encode
+        self.rom = None
+        self.changed = False
+
+    def load(self):
+        if self.rom is not None:
+            return
+        f = open(self.filename, "rb")
+        self.rom = mmap(f.fileno(), 0, access=ACCESS_READ)
+        f.close()
+        data = self.rom[self.address:self.address + (self.count * 2)]
+        # records are keyed by their original offset, so shared ones stay
+        # shared; a record replaced through __setitem__ gets a new key
+        self.keys = [self.base | (ord(data[i*2]) | (ord(data[(i*2)+1]) << 8))
+                     for i in xrange(self.count)]
+        offsets = sorted(set(self.keys))
+        self.lengths = {}
+        for a, b in zip(offsets, offsets[1:]):
+            self.lengths[a] = b - a
+        last = offsets[-1]
+        if self.end is not None:
+            end = self.end
+            if end <= last:
+                raise Exception("Record at %x is past the end at %x." %
+                                (last, end))
+        else:
+            end = self.rom.find(self.terminator, last) + len(self.terminator)
+            if end < len(self.terminator):
+                raise Exception("Unterminated record at %x." % last)
+        self.lengths[last] = end - last
+        self.region = (offsets[0], end)
+        self.records = {}
+        self.decoded = {}
+
+    def get_raw(self, index):
+        self.load()
+        key = self.keys[index]
+        if key not in self.records:
+            count_event("rom_read")
+            self.records[key] = self.rom[key:key + self.lengths[key]]
+        return self.records[key]
+
+    def set_raw(self, index, data):
+        self.load()
+        if data == self.get_raw(index):
+            return
+        key = ("new", index)
+        self.keys[index] = key
+        self.records[key] = data
+        self.decoded.pop(key, None)
+        self.changed = True
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, index):
+        data = self.get_raw(index)
+        if self.decode is None:
+            return data
+        key = self.keys[index]
+        if key not in self.decoded:
+            self.decoded[key] = self.decode(data)
+        return self.decoded[key]
+
+    def __setitem__(self, index, value):
+        if self.encode is not None:
+            value = self.encode(value)
+        self.set_raw(index, value)
+
+    def compact(self):
+        # repack every record into the original region in pointer order,
+        # storing identical records once
+        start, end = self.region
+        placed, pointers = {}, []
+        blob = []
+        position = start
+        for index in xrange(self.count):
+            data = self.get_raw(index)
+            if data not in placed:
+                placed[data] = position
+                blob.append(data)
+                position += len(data)
+            pointers.append(placed[data] - self.base)
+        if position > end:
+            raise Exception("Pointed table at %x is %s bytes too large." %
+                            (self.address, position - end))
+        blob = "".join(blob) + ("\x00" * (end - position))
+        return pointers, blob
+
+    def write(self, filename=None):
+        if self.rom is None or not self.changed:
+            return
+        pointers, blob = self.compact()
+        self.rom.close()
+        self.rom = None
+        # later reads come from the file that was written
+        if filename is not None:
+            self.filename = filename
+        f = open(self.filename, "r+b")
+        f.seek(self.address)
+        f.write("".join([chr(p & 0xFF) + chr(p >> 8) for p in pointers]))
+        f.seek(self.region[0])
+        f.write(blob)
+        f.close()
+        self.changed = False
+
+
+def get_pointed_table(filename, name, label=None):
+    if label is None:
+        label = get_label(md5(open(filename, "rb").read()).hexdigest())
+    tables = POINTED_TABLES.get(label, {})
+    if name not in tables:
+        raise Exception("No %s table for %s." % (name, label))
+    return PointedTable(filename, *tables[name])
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="List the records of a pointed table, to check its "
+                    "bounds against a rom.")
+    parser.add_argument("sourcefile", help="an unheadered rom")
+    parser.add_argument("name", choices=sorted(POINTED_TABLES["SMRPG_NA"]))
+    args = parser.parse_args()
+    label = get_label(md5(open(args.sourcefile, "rb").read()).hexdigest())
+    table = get_pointed_table(args.sourcefile, args.name, label)
+    table.load()
+    for index in xrange(len(table)):
+        key = table.keys[index]
+        data = table[index]
+        if args.name == "psychopath":
+            data = decode(data, label)
+        else:
+            data = data.encode("hex")
+        print "%s %x %s %s" % (index, key, table.lengths[key], data)
+    print "region %x-%x" % table.region
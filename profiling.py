@@ -0,0 +1,124 @@
+from collections import defaultdict
+from os import times
+from time import time
+import json
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+
+PROFILED_METHODS = [
+    "full_randomize", "randomize_all", "mutate_all", "shuffle_all",
+    "groupshuffle", "intershuffle", "randomize", "mutate", "shuffle",
+    "full_cleanup", "cleanup", "get_similar"]
+PROFILE = None
+
+
+def cpu_time():
+    t = times()
+    return t[0] + t[1]
+
+
+def count_event(name, amount=1):
+    if PROFILE is not None:
+        PROFILE["counters"][name] += amount
+
+
+def get_peak_memory():
+    # kilobytes on linux, bytes on mac; None where unsupported
+    if resource is None:
+        return None
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+class profile_phase(object):
+    def __init__(self, owner, phase):
+        self.key = (owner, phase)
+
+    def __enter__(self):
+        if PROFILE is not None:
+            self.start = (time(), cpu_time())
+            PROFILE["depth"][self.key] += 1
+        return self
+
+    def __exit__(self, *args):
+        if PROFILE is None:
+            return
+        depth = PROFILE["depth"]
+        depth[self.key] -= 1
+        record = PROFILE["phases"][self.key]
+        record["calls"] += 1
+        if depth[self.key] == 0:
+            # only the outermost call counts, so recursion isn't doubled
+            record["wall"] += time() - self.start[0]
+            record["cpu"] += cpu_time() - self.start[1]
+
+
+def profiled(owner, phase, function):
+    def wrapped(*args, **kwargs):
+        with profile_phase(owner, phase):
+            return function(*args, **kwargs)
+    wrapped.__name__ = function.__name__
+    wrapped.__doc__ = function.__doc__
+    wrapped.unprofiled = function
+    return wrapped
+
+
+def wrap_class(cls):
+    for name in PROFILED_METHODS:
+        for klass in cls.__mro__:
+            if name in klass.__dict__:
+                method = klass.__dict__[name]
+                break
+        else:
+            continue
+        # inherited methods may already be wrapped for a parent class
+        if isinstance(method, classmethod):
+            function = method.__func__
+            function = getattr(function, "unprofiled", function)
+            method = classmethod(profiled(cls.__name__, name, function))
+        elif callable(method):
+            function = getattr(method, "unprofiled", method)
+            method = profiled(cls.__name__, name, function)
+        else:
+            continue
+        setattr(cls, name, method)
+
+
+def enable_profiling(objects):
+    global PROFILE
+    PROFILE = {
+        "phases": defaultdict(lambda: {"calls": 0, "wall": 0.0, "cpu": 0.0}),
+        "depth": defaultdict(int),
+        "counters": defaultdict(int),
+        "start": (time(), cpu_time()),
+        }
+    for o in objects:
+        wrap_class(o)
+
+
+def get_report(**extra):
+    if PROFILE is None:
+        return None
+    phases = [dict([("class", owner), ("phase", phase)] + sorted(r.items()))
+              for ((owner, phase), r) in sorted(PROFILE["phases"].items())]
+    report = {
+        "phases": phases,
+        "counters": dict(PROFILE["counters"]),
+        "wall": time() - PROFILE["start"][0],
+        "cpu": cpu_time() - PROFILE["start"][1],
+        "peak_memory": get_peak_memory(),
+        }
+    report.update(extra)
+    return report
+
+
+def write_report(filename, **extra):
+    report = get_report(**extra)
+    if report is None:
+        return
+    f = open(filename, "w")
+    json.dump(report, f, indent=2, sort_keys=True)
+    f.close()
@@ -1,16 +1,22 @@
 from randomtools.tablereader import TableObject, get_global_label, tblpath
 from randomtools.utils import (
-    classproperty, mutate_normal, shuffle_bits,
-    utilrandom as random)
+    classproperty, mutate_normal, utilrandom as random)
 from randomtools.interface import (
-    get_outfile, get_seed, get_flags, run_interface, rewrite_snes_meta,
-    clean_and_write, finish_interface)
+    get_outfile, get_seed, get_flags, get_sourcefile, run_interface,
+    rewrite_snes_meta, clean_and_write, finish_interface)
+from digest import record_digests
+from text import decode, encode
+from sampling import make_stream, nested_randint
+from spoiler import enable_change_tracking, write_spoiler
+from profiling import (
+    count_event, enable_profiling, profile_phase, write_report)
 from collections import defaultdict
-from os import path
+from itertools import combinations
+from os import environ, path
+from sys import argv
 
 
 VERSION = 4
-ALL_OBJECTS = None
 LEVEL_STATS = ["max_hp", "attack", "defense", "magic_attack", "magic_defense"]
 EQUIP_STATS = ["speed", "attack", "defense", "magic_attack", "magic_defense"]
 
@@ -20,6 +26,66 @@ iof = open(ITEM_ORDER_FILENAME)
 ITEM_ORDER = [int(line.strip(), 0x10) for line in iof.readlines()
               if line.strip()]
 iof.close()
+ITEM_ORDER_INDEX = dict([(item, n) for (n, item) in enumerate(ITEM_ORDER)])
+
+
+def distribute_decrease(rng, values, amount):
+    # each unit comes off a random value that is still positive
+    values = list(values)
+    candidates = [i for (i, v) in enumerate(values) if v > 0]
+    while amount > 0:
+        assert candidates
+        n = rng.randint(0, len(candidates)-1)
+        i = candidates[n]
+        values[i] -= 1
+        if values[i] <= 0:
+            candidates[n] = candidates[-1]
+            candidates.pop()
+        amount -= 1
+    return values
+
+
+def random_binomial(rng, n, p):
+    if n <= 0 or p <= 0:
+        return 0
+    if p >= 1:
+        return n
+    q = 1 - p
+    prob = q ** n
+    if prob <= 0:
+        value = int(round(rng.gauss(n * p, (n * p * q) ** 0.5)))
+        return min(max(value, 0), n)
+    u = rng.random()
+    k, cumulative = 0, prob
+    while u > cumulative and k < n:
+        prob *= (p / q) * (n - k) / float(k + 1)
+        k += 1
+        cumulative += prob
+    return k
+
+
+def random_split(rng, amount, weights):
+    # multinomial split of amount units, one binomial draw per bucket
+    counts = []
+    remaining = float(sum(weights))
+    for w in weights[:-1]:
+        if remaining > 0:
+            c = random_binomial(rng, amount, w / remaining)
+        else:
+            c = 0
+        counts.append(c)
+        amount -= c
+        remaining -= w
+    counts.append(amount)
+    return counts
+
+
+def shuffle_bits(rng, value, size=8):
+    # the same number of bits set, at random positions
+    numbits = bin(value).count("1")
+    if not numbits:
+        return value
+    return sum([1 << d for d in rng.sample(range(size), numbits)])
 
 
 class CharIndexObject:
@@ -31,17 +97,89 @@ class CharIndexObject:
     def character_id(self):
         return self.index % 5
 
+    @classmethod
+    def get_character_rows(cls, character):
+        def build():
+            rows = defaultdict(list)
+            for c in cls.every:
+                rows[c.character_id].append(c)
+            return rows
+        return get_cache((cls.__name__, "character_rows"), build)[character]
+
     @classmethod
     def get_by_character(cls, character, index):
-        candidates = [c for c in cls.every if c.character_id == character]
-        return candidates[index]
+        return cls.get_character_rows(character)[index]
+
+    @classmethod
+    def get_by_character_level(cls, character, level):
+        return cls.get_by_character(character, level-2)
 
     @property
     def character(self):
         return CharacterObject.get(self.character_id)
 
 
+class IntershuffleObject(object):
+    # randomtools shuffles intershuffle_attributes as usual, then the masked
+    # bits of each attribute in intershuffle_masks are shuffled among the
+    # rows that are still valid, leaving the other bits in place
+    intershuffle_masks = {}
+
+    @classmethod
+    def intershuffle(cls):
+        super(IntershuffleObject, cls).intershuffle()
+        if not cls.intershuffle_masks:
+            return
+        rng = get_stream(cls.__name__)
+        valid = [o for o in cls.every if o.intershuffle_valid]
+        for attr, mask in sorted(cls.intershuffle_masks.items()):
+            values = [getattr(o, attr) & mask for o in valid]
+            rng.shuffle(values)
+            for o, value in zip(valid, values):
+                value |= getattr(o, attr) & ~mask
+                if value != getattr(o, attr):
+                    setattr(o, attr, value)
+
+
+class NameObject(object):
+    def __setattr__(self, attr, value):
+        if attr == "name":
+            clear_cache((type(self).__name__, "names"))
+        super(NameObject, self).__setattr__(attr, value)
+
+    @classmethod
+    def get_names(cls):
+        # every name decoded once, stripped and interned, by index, and
+        # the first index of each lowercased name
+        def build():
+            label = get_global_label()
+            names = [intern(decode(o.name, label).strip())
+                     for o in cls.every]
+            indexes = {}
+            for index, n in enumerate(names):
+                indexes.setdefault(n.lower(), index)
+            return names, indexes
+        return get_cache((cls.__name__, "names"), build)
+
+    @classproperty
+    def names(cls):
+        return cls.get_names()[0]
+
+    @classmethod
+    def get_by_name(cls, name):
+        index = cls.get_names()[1].get(name.strip().lower())
+        if index is None:
+            return None
+        return cls.get(index)
+
+
 class StatObject(CharIndexObject):
+    def __setattr__(self, attr, value):
+        # the first assignment is the table being read
+        if attr in ("max_hp", "physical", "magical") and attr in self.__dict__:
+            self.character.clear_stat_curves()
+        TableObject.__setattr__(self, attr, value)
+
     @property
     def attack(self):
         return self.physical >> 4
@@ -82,7 +220,7 @@ class EnemSpriteObject(TableObject): pass
 class AnimSeqPTRObject(TableObject): pass
 
 
-class MonsterObject(TableObject):
+class MonsterObject(IntershuffleObject, TableObject):
     flag = "m"
     flag_description = "monsters"
     mutate_attributes = {
@@ -102,6 +240,7 @@ class MonsterObject(TableObject):
             "immunities", "weaknesses_approach",
             #"coin_anim_entrance", (floating + random coordinates = freeze?)
         ]
+    intershuffle_masks = {"hit_special_defense": 0xFC}
     banned_indexes = [
         0x4e, 0x61, 0x81, 0x82, 0x83, 0x84, 0x85, 0x8d, 0x8e, 0x96, 0x97, 0x98,
         0xa0, 0xa1, 0xab, 0xac, 0xad, 0xae, 0xaf, 0xb4, 0xb7, 0xb9, 0xba,
@@ -119,6 +258,7 @@ class MonsterObject(TableObject):
         if hasattr(self, "_in_a_formation"):
             return self._in_a_formation
 
+        count_event("in_a_formation_cache_miss")
         for e in MonsterObject.every:
             e._in_a_formation = False
         for p in PackObject.every:
@@ -138,6 +278,7 @@ class MonsterObject(TableObject):
             return self._vram_value
         anim_index = EnemSpriteObject.get(self.index).animation
         ptr = AnimSeqPTRObject.get(anim_index).anim_seq_ptr & 0x3fffff
+        count_event("rom_read")
         f = open(get_outfile(), "r+b")
         f.seek(ptr + 8)
         self._vram_value = ord(f.read(1))
@@ -146,7 +287,7 @@ class MonsterObject(TableObject):
 
     @property
     def name(self):
-        return MonsterNameObject.get(self.index).name
+        return MonsterNameObject.names[self.index]
 
     @property
     def rank(self):
@@ -169,54 +310,52 @@ class MonsterObject(TableObject):
     def event_on_death(self):
         return self.misc & 1
 
+    @classproperty
+    def boss_indexes(cls):
+        # misc and the banned list never change, so this is computed once
+        return get_cache((cls.__name__, "boss_indexes"), lambda: frozenset(
+            [m.index for m in cls.every if m.banned or m.event_on_death]))
+
     @property
     def is_boss(self):
-        if self.banned or self.event_on_death:
-            return True
-        return False
-
-    @classmethod
-    def intershuffle(cls):
-        super(MonsterObject, cls).intershuffle()
-        valid = [m for m in cls.every if m.intershuffle_valid]
-        hitspecs = [m.hit_special_defense & 0xFC for m in valid]
-        random.shuffle(hitspecs)
-        for hs, m in zip(hitspecs, valid):
-            m.hit_special_defense = (m.hit_special_defense & 0x03) | hs
+        return self.index in self.boss_indexes
 
     def mutate(self):
-        oldstats = {}
-        for key in self.mutate_attributes:
-            oldstats[key] = getattr(self, key)
+        is_boss = self.is_boss
+        if is_boss:
+            # bosses never get weaker
+            oldstats = [(attr, getattr(self, attr))
+                        for attr in self.mutate_attributes]
         super(MonsterObject, self).mutate()
-        if self.is_boss:
-            for (attr, oldval) in oldstats.items():
+        if is_boss:
+            for (attr, oldval) in oldstats:
                 if getattr(self, attr) < oldval:
                     setattr(self, attr, oldval)
 
-        if self.is_boss:
+        rng = get_stream("MonsterObject")
+        if is_boss:
             while True:
-                chance = random.randint(0, 3)
+                chance = rng.randint(0, 3)
                 if chance == 0:
                     break
                 if chance == 1:
-                    self.resistances |= (1 << random.randint(4, 7))
+                    self.resistances |= (1 << rng.randint(4, 7))
                 elif chance == 2:
-                    self.immunities |= (1 << random.randint(0, 3))
+                    self.immunities |= (1 << rng.randint(0, 3))
                 elif chance == 3:
-                    weak = (1 << random.randint(4, 7))
+                    weak = (1 << rng.randint(4, 7))
                     if self.weaknesses_approach & weak:
                         self.weaknesses_approach ^= weak
         else:
-            resistances = shuffle_bits(self.resistances >> 4, size=4)
+            resistances = shuffle_bits(rng, self.resistances >> 4, size=4)
             self.resistances = resistances << 4
-            self.immunities = shuffle_bits(self.immunities, size=4)
-            weak = shuffle_bits(self.weaknesses_approach >> 4, size=4)
+            self.immunities = shuffle_bits(rng, self.immunities, size=4)
+            weak = shuffle_bits(rng, self.weaknesses_approach >> 4, size=4)
             self.weaknesses_approach &= 0x0F
             self.weaknesses_approach |= (weak << 4)
-            if random.randint(1, 3) == 3:
+            if rng.randint(1, 3) == 3:
                 self.hit_special_defense ^= 0x2
-            self.hit_special_defense ^= (random.randint(0, 3) << 2)
+            self.hit_special_defense ^= (rng.randint(0, 3) << 2)
 
     @classmethod
     def full_cleanup(cls):
@@ -228,7 +367,7 @@ class MonsterObject(TableObject):
         super(MonsterObject, cls).full_cleanup()
 
 
-class MonsterNameObject(TableObject): pass
+class MonsterNameObject(NameObject, TableObject): pass
 
 
 class MonsterAttackObject(TableObject):
@@ -264,17 +403,17 @@ class MonsterAttackObject(TableObject):
     def mutate(self):
         if self.index in self.restricted_indexes:
             return
+        rng = get_stream("MonsterAttackObject")
         if self.multiplier <= 7 and not self.buffs:
-            new_multiplier = random.randint(0, random.randint(
-                0, random.randint(0, random.randint(0, 8))))
+            new_multiplier = nested_randint(rng, 0, (0, (0, (0, 8))))
             if new_multiplier > self.multiplier:
                 self.misc_multiplier = new_multiplier
-        if not self.buffs and random.randint(1, 5) == 5:
-            i = random.randint(0, 6)
-            if i != 4 or random.randint(1, 10) == 10:
+        if not self.buffs and rng.randint(1, 5) == 5:
+            i = rng.randint(0, 6)
+            if i != 4 or rng.randint(1, 10) == 10:
                 self.ailments = (0 | 1 << i)
-        if self.buffs and random.choice([True, False]):
-            self.buffs |= 1 << random.randint(3, 6)
+        if self.buffs and rng.choice([True, False]):
+            self.buffs |= 1 << rng.randint(3, 6)
         super(MonsterAttackObject, self).mutate()
 
 
@@ -284,6 +423,21 @@ class MonsterRewardObject(TableObject):
                          "coins": (0, 255),
                          }
     intershuffle_attributes = ["xp", "coins", "drop", "rare_drop"]
+    item_pools = {
+        "drop": lambda m: m("consumable") & ~m("reuseable") & ~m("banned"),
+        "yoshi_cookie": lambda m: m("consumable") & ~m("banned"),
+        }
+
+    @classmethod
+    def get_item_pool(cls, name):
+        # rebuilt only when the item categories behind it change
+        mask = cls.item_pools[name](ItemObject.get_mask)
+        pools = get_cache((cls.__name__, "item_pools"), dict)
+        if name not in pools or pools[name][0] != mask:
+            count_event("reward_pool_rebuild")
+            pool = sorted(ItemObject.get_masked(mask), key=lambda i: i.rank)
+            pools[name] = (mask, pool)
+        return pools[name][1]
 
     @property
     def intershuffle_valid(self):
@@ -331,8 +485,7 @@ class MonsterRewardObject(TableObject):
             self.xp = min(oldxp, self.xp)
         else:
             self.xp = max(oldxp, self.xp)
-        consumables = [i for i in ItemObject.every
-                       if i.is_consumable and not i.reuseable and not i.banned]
+        consumables = self.get_item_pool("drop")
         if self.drop == self.rare_drop:
             linked = True
         else:
@@ -347,8 +500,7 @@ class MonsterRewardObject(TableObject):
     def randomize(self):
         if self.monster.morph_chance and not self.monster.banned:
             self.yoshi_cookie = random.choice(
-                [i for i in ItemObject.every
-                 if i.is_consumable and not i.banned]).index
+                self.get_item_pool("yoshi_cookie")).index
         else:
             self.yoshi_cookie = 0xFF
 
@@ -363,7 +515,7 @@ class PackObject(TableObject):
     def __repr__(self):
         s = "PACK %x (%x) %s\n" % (
             self.index, self.misc,
-            [e.name.strip() for e in self.common_enemies])
+            [e.name for e in self.common_enemies])
         if len(set(self.formation_ids)) == 1:
             formations = [self.formations[0]]
         else:
@@ -412,7 +564,7 @@ class FormationObject(TableObject):
                            getattr(self, "monster%s_y" % i))
             m = MonsterObject.get(index)
             if h == "1" or p == "1":
-                s += "%x %s" % (index, m.name.strip())
+                s += "%x %s" % (index, m.name)
                 if m in self.leaders:
                     s += "*"
             if h != "1" and p == "1":
@@ -468,6 +620,7 @@ class FormationObject(TableObject):
     @property
     def leaders(self):
         if not hasattr(self, "_leaders"):
+            count_event("leaders_cache_miss")
             for f in FormationObject.every:
                 f._leaders = set([])
             for p in PackObject.every:
@@ -485,6 +638,7 @@ class FormationObject(TableObject):
         if hasattr(cls, "_valid_coordinates"):
             return cls._valid_coordinates
 
+        count_event("valid_coordinates_cache_miss")
         cls._valid_coordinates = set([])
         for f in FormationObject.every:
             if not f.bosses:
@@ -537,26 +691,39 @@ class FormationObject(TableObject):
         MAX_ENEMIES = 6
         if self.bosses or self.enemies_hidden or not self.enemies_present:
             return
+        rng = get_stream("FormationObject")
         candidates = list(self.leaders)
         while len(candidates) < 3:
-            base = random.choice(candidates)
+            count_event("formation_candidate_retry")
+            base = rng.choice(candidates)
             new = base.get_similar()
             if new not in candidates:
                 candidates.append(new)
         assert len(set(candidates)) <= 3
-        num_enemies = random.randint(1, random.randint(3, MAX_ENEMIES))
+        num_enemies = nested_randint(rng, 1, (3, MAX_ENEMIES))
         num_enemies = max(num_enemies, len(self.leaders))
         chosen_enemies = list(self.leaders)
+        # every pick is uniform over candidates + chosen_enemies, among the
+        # enemies that still fit in vram. every chosen enemy is a candidate,
+        # so once the lightest candidate stops fitting nothing does; until
+        # then, picks that don't fit are drawn again
+        lightest = min([e.vram_value for e in candidates])
+        vram_total = sum([e.vram_value for e in chosen_enemies])
         while len(chosen_enemies) < num_enemies:
-            vram_total = sum([e.vram_value for e in chosen_enemies])
-            sub_candidates = candidates + chosen_enemies
-            sub_candidates = [e for e in sub_candidates
-                              if vram_total + e.vram_value <= 64]
-            if not sub_candidates:
+            if vram_total + lightest > 64:
                 num_enemies = len(chosen_enemies)
                 break
-            chosen_enemies.append(random.choice(sub_candidates))
-        random.shuffle(chosen_enemies)
+            while True:
+                n = rng.randint(0, len(candidates) + len(chosen_enemies) - 1)
+                if n < len(candidates):
+                    e = candidates[n]
+                else:
+                    e = chosen_enemies[n - len(candidates)]
+                if vram_total + e.vram_value <= 64:
+                    break
+            chosen_enemies.append(e)
+            vram_total += e.vram_value
+        rng.shuffle(chosen_enemies)
 
         def mutate_coordinate((x, y)):
             x = mutate_normal(x, minimum=self.lower_x, maximum=self.upper_x)
@@ -581,10 +748,10 @@ class FormationObject(TableObject):
             if i < len(chosen_enemies):
                 e = chosen_enemies[i].index
                 if not done_coordinates:
-                    (x, y) = random.choice(self.valid_coordinates)
+                    (x, y) = rng.choice(self.valid_coordinates)
                     (x, y) = mutate_coordinate((x, y))
                 else:
-                    candidates = random.sample(self.valid_coordinates,
+                    candidates = rng.sample(self.valid_coordinates,
                                                len(chosen_enemies)*2)
                     candidates = map(mutate_coordinate, candidates)
                     (x, y) = select_most_distance(candidates, done_coordinates)
@@ -617,26 +784,16 @@ class CharacterObject(TableObject):
     def stats(self):
         if hasattr(self, "_stats"):
             return self._stats
-        self._stats = [s for s in (StatGrowthObject.every +
-                                   StatBonusObject.every)
-                       if s.character_id == self.index]
+        self._stats = self.growth_stats + self.bonus_stats
         return self.stats
 
     @property
     def growth_stats(self):
-        if hasattr(self, "_growth_stats"):
-            return self._growth_stats
-        self._growth_stats = [s for s in StatGrowthObject.every
-                              if s.character_id == self.index]
-        return self.growth_stats
+        return StatGrowthObject.get_character_rows(self.index)
 
     @property
     def bonus_stats(self):
-        if hasattr(self, "_bonus_stats"):
-            return self._bonus_stats
-        self._bonus_stats = [s for s in StatBonusObject.every
-                             if s.character_id == self.index]
-        return self.bonus_stats
+        return StatBonusObject.get_character_rows(self.index)
 
     def cleanup(self):
         self.current_hp = self.max_hp
@@ -644,8 +801,8 @@ class CharacterObject(TableObject):
         self.armor = 0xFF
         self.accessory = 0xFF
 
-        my_learned = [l for l in LearnObject.every if l.level <= self.level
-                      and l.character_id == self.index]
+        my_learned = LearnObject.get_character_rows(self.index)
+        my_learned = my_learned[:max(self.level-1, 0)]
         for l in my_learned:
             if l.spell <= 0x1A:
                 self.known_spells |= (1 << l.spell)
@@ -664,34 +821,55 @@ class CharacterObject(TableObject):
                 setattr(self, attr, getattr(self, attr) + getattr(s, attr))
 
         # 255 maximum
+        self.clear_stat_curves()
         for attr in LEVEL_STATS:
-            while self.get_max_stat_at_level(attr, 30) > 255:
-                ss = [s for s in self.stats if self.level < s.level
-                      and getattr(s, attr) > 0]
-                s = random.choice(ss)
-                value = getattr(s, attr)
-                s.set_stat(attr, value-1)
+            excess = self.get_max_stat_at_level(attr, 30) - 255
+            if excess <= 0:
+                continue
+            ss = [s for s in self.stats if self.level < s.level
+                  and getattr(s, attr) > 0]
+            values = distribute_decrease(get_stream("CharacterObject"),
+                                         [getattr(s, attr) for s in ss],
+                                         excess)
+            for s, value in zip(ss, values):
+                if value != getattr(s, attr):
+                    s.set_stat(attr, value)
 
         if self.level == 1:
             self.xp = 0
         else:
             self.xp = LevelUpXPObject.get(self.level-2).xp
 
-    def get_stat_at_level(self, attr, level):
-        my_growths = [s for s in self.growth_stats
-                      if self.level < s.level <= level]
+    def clear_stat_curves(self):
+        clear_cache((type(self).__name__, "stat_curves", self.index))
+
+    def get_stat_curve(self, attr, bonus=False):
+        # cumulative increases from level 1, indexed by level
+        curves = get_cache((type(self).__name__, "stat_curves", self.index),
+                           dict)
+        key = (attr, bonus)
+        if key in curves:
+            return curves[key]
+        increases = [0] * 31
+        stats = self.stats if bonus else self.growth_stats
+        for s in stats:
+            increases[s.level] += getattr(s, attr)
+        curve = []
+        for inc in increases:
+            curve.append(inc + (curve[-1] if curve else 0))
+        curves[key] = curve
+        return self.get_stat_curve(attr, bonus)
+
+    def get_stat_at_level(self, attr, level, bonus=False):
         value = getattr(self, attr)
-        for g in my_growths:
-            value += getattr(g, attr)
-        return value
+        curve = self.get_stat_curve(attr, bonus)
+        level = min(level, len(curve)-1)
+        if level <= self.level:
+            return value
+        return value + curve[level] - curve[self.level]
 
     def get_max_stat_at_level(self, attr, level):
-        value = self.get_stat_at_level(attr, level)
-        my_bonuses = [s for s in self.bonus_stats
-                      if self.level < s.level <= level]
-        for b in my_bonuses:
-            value += getattr(b, attr)
-        return value
+        return self.get_stat_at_level(attr, level, bonus=True)
 
 
 class ItemObject(TableObject):
@@ -708,19 +886,55 @@ class ItemObject(TableObject):
     geno - noknok shell
     geno - frying pan
     '''
+    category_attributes = ["useable_itemtype", "equippable", "variance",
+                           "misc_attack", "status_cursor", "targetting"]
+    category_conditions = {
+        "weapon": lambda i: i.is_weapon,
+        "armor": lambda i: i.is_armor,
+        "accessory": lambda i: i.is_accessory,
+        "equipment": lambda i: i.is_equipment,
+        "consumable": lambda i: i.is_consumable,
+        "key": lambda i: i.is_key,
+        "reuseable": lambda i: i.reuseable,
+        "banned": lambda i: i.banned,
+        "all": lambda i: i.get_bit("all"),
+        "status_nullification": lambda i: i.get_bit("status_nullification"),
+        "misc_attack_124": lambda i: i.misc_attack in [1, 2, 4],
+        "misc_attack_1245": lambda i: i.misc_attack in [1, 2, 4, 5],
+        "mario": lambda i: i.get_bit("mario"),
+        "toadstool": lambda i: i.get_bit("toadstool"),
+        "bowser": lambda i: i.get_bit("bowser"),
+        "geno": lambda i: i.get_bit("geno"),
+        "mallow": lambda i: i.get_bit("mallow"),
+        }
+
+    def __setattr__(self, attr, value):
+        if attr in ItemObject.category_attributes:
+            clear_cache(("ItemObject", "category_masks"))
+        super(ItemObject, self).__setattr__(attr, value)
+
+    @classmethod
+    def get_mask(cls, category):
+        # bit n is set if item n belongs to the category
+        def build():
+            count_event("item_mask_rebuild")
+            masks = dict([(c, 0) for c in cls.category_conditions])
+            for i in cls.every:
+                for c, condition in cls.category_conditions.items():
+                    if condition(i):
+                        masks[c] |= (1 << i.index)
+            return masks
+        return get_cache(("ItemObject", "category_masks"), build)[category]
+
+    @classmethod
+    def get_masked(cls, mask):
+        return [i for i in cls.every if mask & (1 << i.index)]
 
     @classmethod
     def classify_rare(cls):
-        for s in ShopObject.every:
-            if s.uses_frog_coins:
-                continue
-            for i in s.items:
-                item = ItemObject.get(i)
-                item._rare = False
         for i in ItemObject.every:
-            if hasattr(i, "rare"):
-                continue
-            i._rare = True
+            i._rare = all([p.uses_frog_coins for (p, _)
+                           in ShopObject.get_item_shops(i.index)])
 
     @property
     def rare(self):
@@ -733,11 +947,13 @@ class ItemObject(TableObject):
     def rank(self):
         if hasattr(self, "_rank"):
             return self._rank
+        count_event("rank_cache_miss")
         price = PriceObject.get(self.index).price
         if self.banned:
             self._rank = -1
         elif price == 0 and not self.is_key:
-            self._rank = random.randint(1, random.randint(1, 999))
+            self._rank = nested_randint(get_stream("ItemObject"),
+                                        1, (1, 999))
         elif price == 0:
             self._rank = -1
         elif self.is_frog_coin_item:
@@ -764,7 +980,7 @@ class ItemObject(TableObject):
 
     @property
     def name(self):
-        return ItemNameObject.get(self.index).name
+        return ItemNameObject.names[self.index]
 
     @property
     def price(self):
@@ -774,10 +990,10 @@ class ItemObject(TableObject):
     def is_frog_coin_item(self):
         if hasattr(self, "_is_frog_coin_item"):
             return self._is_frog_coin_item
-        for p in ShopObject.every:
-            if self.index in p.items:
-                self._is_frog_coin_item = p.uses_frog_coins
-                break
+        shops = ShopObject.get_item_shops(self.index)
+        if shops:
+            p, _ = shops[0]
+            self._is_frog_coin_item = p.uses_frog_coins
         else:
             self._is_frog_coin_item = False
         return self.is_frog_coin_item
@@ -785,7 +1001,8 @@ class ItemObject(TableObject):
     def become_frog_coin_item(self):
         if self.is_frog_coin_item:
             return False
-        factor = float(random.randint(random.randint(10, 50), 50))
+        factor = float(nested_randint(get_stream("ItemObject"),
+                                      (10, 50), 50))
         if self.rare:
             price = int(round(self.rank / factor))
         else:
@@ -797,7 +1014,8 @@ class ItemObject(TableObject):
     def unbecome_frog_coin_item(self):
         if not self.is_frog_coin_item:
             return False
-        factor = float(random.randint(50, random.randint(50, 100)))
+        factor = float(nested_randint(get_stream("ItemObject"),
+                                      50, (50, 100)))
         price = int(round(self.price * factor))
         PriceObject.get(self.index).price = min(price, 1998)
         self._is_frog_coin_item = False
@@ -865,45 +1083,55 @@ class ItemObject(TableObject):
     def reuseable(self):
         return self.useable_itemtype & 0x20
 
+    def choose_ups(self, rng, num_up):
+        # same odds as rerolling until a primary stat is included
+        existing = [attr for attr in EQUIP_STATS
+                    if 1 <= getattr(self, attr) <= 127]
+        samples = [list(c) for c in combinations(EQUIP_STATS, num_up)]
+        valid = [c for c in samples if set(c) & set(self.primary_stats)]
+        if existing:
+            p = 1 / 3.0
+            p = p / (p + ((1 - p) * len(valid) / float(len(samples))))
+            if rng.random() < p:
+                return existing
+        return rng.choice(valid)
+
     def mutate(self):
         if not self.is_equipment:
             return
+        rng = get_stream("ItemObject")
         score = self.stat_point_value
-        num_up = bin(random.randint(1, 31)).count('1')
-        num_down = bin(random.randint(0, 31)).count('1')
-        while True:
-            if random.choice([True, False, False]):
-                ups = [attr for attr in EQUIP_STATS
-                       if 1 <= getattr(self, attr) <= 127]
-                if ups:
-                    break
-            ups = random.sample(EQUIP_STATS, num_up)
-            if set(ups) & set(self.primary_stats):
-                break
-        ups = dict([(u, 0) for u in ups])
-        if random.choice([True, False, False]):
+        num_up = bin(rng.randint(1, 31)).count('1')
+        num_down = bin(rng.randint(0, 31)).count('1')
+        ups = self.choose_ups(rng, num_up)
+        if rng.choice([True, False, False]):
             downs = [attr for attr in EQUIP_STATS
                    if getattr(self, attr) >= 128]
         else:
-            downs = random.sample(EQUIP_STATS, num_down)
-        downs = dict([(d, 0) for d in downs if d not in ups])
+            downs = rng.sample(EQUIP_STATS, num_down)
+        downs = [d for d in downs if d not in ups]
         if downs:
             if score != 0:
-                downpoints = random.randint(0, random.randint(0, score))
+                downpoints = nested_randint(rng, 0, (0, score))
             else:
-                downpoints = random.randint(0, random.randint(0, random.randint(0, 100)))
-            while downpoints > 0:
-                attr = random.choice(downs.keys())
-                downs[attr] += 1
-                downpoints -= 1
-                score += 1
+                downpoints = nested_randint(rng, 0, (0, (0, 100)))
+            downs = dict(zip(downs, random_split(rng, downpoints,
+                                                 [1] * len(downs))))
+            score += downpoints
+        else:
+            downs = {}
+
+        # primary stats cost 1 point, others cost 2
+        costs = [1 if attr in self.primary_stats else 2 for attr in ups]
+        counts = [0] * len(ups)
         while score > 0:
-            attr = random.choice(ups.keys())
-            ups[attr] += 1
-            if attr in self.primary_stats:
-                score -= 1
-            else:
-                score -= 2
+            # every one of these picks happens before the score runs out
+            picks = (score + max(costs) - 1) / max(costs)
+            for n, c in enumerate(random_split(rng, picks,
+                                               [1] * len(ups))):
+                counts[n] += c
+                score -= c * costs[n]
+        ups = dict(zip(ups, counts))
 
         for attr in EQUIP_STATS:
             setattr(self, attr, 0)
@@ -923,9 +1151,9 @@ class ItemObject(TableObject):
             return
 
         equippable = self.equippable & 0xE0
-        num_equippable = random.randint(1,random.randint(1, 5))
+        num_equippable = nested_randint(rng, 1, (1, 5))
         for _ in xrange(num_equippable):
-            equippable |= (1 << random.randint(0, 4))
+            equippable |= (1 << rng.randint(0, 4))
 
         if self.is_weapon:
             equippable = equippable & 0xF7
@@ -943,7 +1171,7 @@ class ItemObject(TableObject):
             self.set_bit("single_enemy", True)
 
 
-class ItemNameObject(TableObject): pass
+class ItemNameObject(NameObject, TableObject): pass
 class PriceObject(TableObject): pass
 
 
@@ -973,6 +1201,77 @@ class LevelUpXPObject(TableObject):
 class StatGrowthObject(StatObject, TableObject):
     flag = "c"
 
+    @classmethod
+    def generate_curve(cls, value, attr, rng):
+        fixed_points = [(1, 0), (20, value)]
+        for _ in xrange(3):
+            dex = rng.randint(1, len(fixed_points)-1)
+            lower_level, lower_value = fixed_points[dex-1]
+            upper_level, upper_value = fixed_points[dex]
+            if upper_level - lower_level < 4:
+                continue
+            level_interval = (upper_level - lower_level) / 2
+            value_interval = (upper_value - lower_value) / 2
+            level = (lower_level + rng.randint(0, level_interval)
+                     + rng.randint(0, level_interval))
+            if level <= lower_level or level >= upper_level:
+                continue
+            value = (lower_value + rng.randint(0, value_interval)
+                     + rng.randint(0, value_interval))
+            fixed_points.insert(dex, (level, value))
+
+        values = []
+        for ((l1, v1), (l2, v2)) in zip(fixed_points, fixed_points[1:]):
+            ldist = float(l2 - l1)
+            values.extend([int(round(v1 + (((l - l1) / ldist) * (v2 - v1))))
+                           for l in xrange(l1, l2)])
+        values.append(fixed_points[-1][1])
+        assert len(values) == 20
+        assert values == sorted(values)
+        increases = [v2 - v1 for (v1, v2) in zip(values, values[1:])]
+
+        frontload_factor = rng.random() * rng.random()
+        if attr in ["defense", "magic_defense"]:
+            frontload_factor *= rng.random()
+        max_index = len(increases) - 1
+        amounts = [int(round(inc * (((max_index-n) / float(max_index))
+                                    * frontload_factor)))
+                   for (n, inc) in enumerate(increases)]
+        frontloaded = max(sum(amounts), 1)
+        increases = [inc - amount for (inc, amount) in zip(increases, amounts)]
+
+        # no more than 15 per level, the excess goes to other levels
+        excess = sum([max(inc - 15, 0) for inc in increases])
+        increases = [min(inc, 15) for inc in increases]
+        choices = [n for (n, inc) in enumerate(increases) if inc < 15]
+        while excess > 0:
+            n = rng.randint(0, len(choices))
+            if n == len(choices):
+                frontloaded += 1
+            else:
+                i = choices[n]
+                increases[i] += 1
+                if increases[i] >= 15:
+                    choices[n] = choices[-1]
+                    choices.pop()
+            excess -= 1
+
+        return frontloaded, increases
+
+    @classmethod
+    def generate_curves(cls):
+        curves = defaultdict(list)
+        for c in CharacterObject.every:
+            rows = [l for l in cls.get_character_rows(c.index)
+                    if l.level <= 20]
+            for attr in LEVEL_STATS:
+                value = getattr(c, attr) + sum([getattr(l, attr)
+                                                for l in rows])
+                value = mutate_normal(value, maximum=255)
+                curves[attr].append(cls.generate_curve(
+                    value, attr, get_stream("StatGrowthObject")))
+        return curves
+
     @classmethod
     def full_randomize(cls):
         if hasattr(cls, "after_order"):
@@ -980,73 +1279,7 @@ class StatGrowthObject(StatObject, TableObject):
                 if not (hasattr(cls2, "randomized") and cls2.randomized):
                     raise Exception("Randomize order violated.")
         cls.randomized = True
-        curves = defaultdict(list)
-        for character_index in range(5):
-            c = CharacterObject.get(character_index)
-            for attr in LEVEL_STATS:
-                value = getattr(c, attr)
-                for l in cls.every:
-                    if l.character_id == c.index and l.level <= 20:
-                        value += getattr(l, attr)
-                value = mutate_normal(value, maximum=255)
-                fixed_points = [(1, 0), (20, value)]
-                for _ in xrange(3):
-                    dex = random.randint(1, len(fixed_points)-1)
-                    lower_level, lower_value = fixed_points[dex-1]
-                    upper_level, upper_value = fixed_points[dex]
-                    if upper_level - lower_level < 4:
-                        continue
-                    level_interval = (upper_level - lower_level) / 2
-                    value_interval = (upper_value - lower_value) / 2
-                    level = (lower_level + random.randint(0, level_interval)
-                             + random.randint(0, level_interval))
-                    if level <= lower_level or level >= upper_level:
-                        continue
-                    value = (lower_value + random.randint(0, value_interval)
-                             + random.randint(0, value_interval))
-                    fixed_points.append((level, value))
-                    fixed_points = sorted(fixed_points)
-
-                for ((l1, v1), (l2, v2)) in zip(fixed_points, fixed_points[1:]):
-                    ldist = l2 - l1
-                    vdist = v2 - v1
-                    for l in range(l1+1, l2):
-                        factor = (l - l1) / float(ldist)
-                        v = v1 + (factor * vdist)
-                        fixed_points.append((l, int(round(v))))
-                fixed_points = sorted(fixed_points)
-                levels, values = zip(*fixed_points)
-                assert len(fixed_points) == 20
-                assert levels == tuple(sorted(levels))
-                assert values == tuple(sorted(values))
-                increases = []
-                for v1, v2 in zip(values, values[1:]):
-                    increases.append(v2-v1)
-
-                frontload_factor = random.random() * random.random()
-                if attr in ["defense", "magic_defense"]:
-                    frontload_factor *= random.random()
-                frontloaded = 0
-                for n, inc in enumerate(increases):
-                    max_index = len(increases) - 1
-                    factor = (((max_index-n) / float(max_index))
-                              * frontload_factor)
-                    amount = int(round(inc * factor))
-                    frontloaded += amount
-                    increases[n] = (inc - amount)
-                frontloaded = max(frontloaded, 1)
-
-                while max(increases) > 15:
-                    i = increases.index(max(increases))
-                    increases[i] = increases[i] - 1
-                    choices = [n for (n, v) in enumerate(increases) if v < 15]
-                    if random.randint(0, len(choices)) == 0:
-                        frontloaded += 1
-                    elif choices:
-                        i = random.choice(choices)
-                        increases[i] = increases[i] + 1
-
-                curves[attr].append((frontloaded, increases))
+        curves = cls.generate_curves()
 
         for attr in LEVEL_STATS:
             attr_curves = curves[attr]
@@ -1056,27 +1289,32 @@ class StatGrowthObject(StatObject, TableObject):
                 c = CharacterObject.get(character_index)
                 if c.index == 0 and attr in ["max_hp", "attack"]:
                     # ensure basic starting stats for Mario
-                    while base < 20:
-                        base += 1
-                        for i in range(len(increases)):
-                            if increases[i] > 0:
-                                increases[i] = increases[i] - 1
-                                break
-                getattr(c, attr)
+                    needed = max(20 - base, 0)
+                    base += needed
+                    for i, inc in enumerate(increases):
+                        if not needed:
+                            break
+                        amount = min(inc, needed)
+                        increases[i] = inc - amount
+                        needed -= amount
                 setattr(c, attr, base)
                 assert len(increases) == 19
-                for s in StatGrowthObject.every:
-                    if s.character_id == c.index:
-                        if increases:
-                            s.set_stat(attr, increases.pop(0))
-                        else:
-                            s.set_stat(attr, mutate_normal(2))
+                for s in cls.get_character_rows(c.index):
+                    if increases:
+                        s.set_stat(attr, increases.pop(0))
+                    else:
+                        s.set_stat(attr, mutate_normal(2))
 
 
 class StatBonusObject(StatObject, TableObject):
     flag = "c"
     intershuffle_attributes = ["max_hp", "physical", "magical"]
 
+    def __setattr__(self, attr, value):
+        if attr in StatBonusObject.intershuffle_attributes:
+            clear_cache(("StatBonusObject", "mutate_pool"))
+        StatObject.__setattr__(self, attr, value)
+
     @property
     def intershuffle_valid(self):
         return self.level <= 20
@@ -1094,13 +1332,20 @@ class StatBonusObject(StatObject, TableObject):
         a, b = options[0]
         return b
 
+    @classproperty
+    def mutate_pool(cls):
+        # the current values of the full rows, rebuilt after any of them
+        # changes, as mutating earlier rows changes the later pools
+        return get_cache(("StatBonusObject", "mutate_pool"), lambda: [
+            [getattr(s, attr) for attr in cls.intershuffle_attributes]
+            for s in cls.every if s.intershuffle_valid and
+            all([getattr(s, attr) for attr in cls.intershuffle_attributes])])
+
     def mutate(self):
-        valids = [s for s in StatBonusObject.every if s.intershuffle_valid and
-                  all([getattr(s, attr)
-                       for attr in self.intershuffle_attributes])]
-        for attr in self.intershuffle_attributes:
-            while getattr(self, attr) == 0:
-                setattr(self, attr, getattr(random.choice(valids), attr))
+        pool = self.mutate_pool
+        for n, attr in enumerate(self.intershuffle_attributes):
+            if getattr(self, attr) == 0:
+                setattr(self, attr, random.choice(pool)[n])
         for attr in LEVEL_STATS:
             self.set_stat(attr, mutate_normal(
                 getattr(self, attr), minimum=0, maximum=0xf))
@@ -1117,13 +1362,14 @@ class SpellObject(TableObject):
 
     @property
     def name(self):
-        return SpellNameObject.get(self.index).name
+        return SpellNameObject.names[self.index]
 
     def set_name(self, name):
-        SpellNameObject.get(self.index).name = name
+        o = SpellNameObject.get(self.index)
+        o.name = encode(name, get_global_label(), length=len(o.name))
 
 
-class SpellNameObject(TableObject): pass
+class SpellNameObject(NameObject, TableObject): pass
 
 
 class LearnObject(CharIndexObject, TableObject):
@@ -1140,34 +1386,37 @@ class LearnObject(CharIndexObject, TableObject):
             for cls2 in cls.after_order:
                 if not (hasattr(cls2, "randomized") and cls2.randomized):
                     raise Exception("Randomize order violated.")
+        rng = get_stream("LearnObject")
         for c in CharacterObject.every:
             c.known_spells = 0
         spells = range(0x1b)
         spells.remove(7)  # group hug
-        random.shuffle(spells)
+        rng.shuffle(spells)
         supplemental = [0xFF] * 3
         spells = spells + supplemental
         charspells = defaultdict(list)
+        # toadstool has one slot fewer, for group hug
+        capacities = [6, 5, 6, 6, 6]
+        valid = range(5)
         while spells:
-            valid = [i for i in range(5) if len(charspells[i]) < 5 or
-                     (len(charspells[i]) < 6 and i != 1)]
-            chosen = random.choice(valid)
+            chosen = rng.choice(valid)
             spell = spells.pop(0)
             if spell == 0xFF:
-                valid = [s for s in range(0x1b) if s not in charspells[i]
-                         and s != 7]  # group hug
-                spell = random.choice(valid)
+                spell = rng.choice([s for s in range(0x1b) if s != 7
+                                    and s not in charspells[chosen]])
             charspells[chosen].append(spell)
-        charspells[1].insert(random.randint(0, 5), 7)
+            if len(charspells[chosen]) >= capacities[chosen]:
+                valid.remove(chosen)
+        charspells[1].insert(rng.randint(0, 5), 7)
         for l in LearnObject.every:
             l.spell = 0xFF
         for i in range(5):
-            charlevels = sorted(random.sample(range(2, 20), 5))
+            charlevels = sorted(rng.sample(range(2, 20), 5))
             spells = charspells[i]
             c = CharacterObject.get(i)
             c.known_spells |= (1 << spells[0])
             for l, s in zip(charlevels, spells[1:]):
-                l = LearnObject.get_by_character(i, l-2)
+                l = LearnObject.get_by_character_level(i, l)
                 l.spell = s
         cls.randomized = True
 
@@ -1178,6 +1427,11 @@ class WeaponTimingObject(TableObject): pass
 class ShopObject(TableObject):
     flag = "p"
     flag_description = "shops"
+    disciple_shop = 3
+    frog_coin_emporium = 6
+    juice_bar_partial = [9, 10, 11]
+    num_frog_items = 25
+    max_backtracks = 20
 
     @classproperty
     def after_order(self):
@@ -1185,13 +1439,32 @@ class ShopObject(TableObject):
             return [ItemObject]
         return []
 
+    def __setattr__(self, attr, value):
+        if attr == "items":
+            clear_cache(("ShopObject", "item_shops"))
+        super(ShopObject, self).__setattr__(attr, value)
+
+    @classmethod
+    def get_item_shops(cls, item_index):
+        # (shop, slot) pairs for every shop stocking the item
+        def build():
+            count_event("shop_index_rebuild")
+            item_shops = defaultdict(list)
+            for p in ShopObject.every:
+                for slot, i in enumerate(p.items):
+                    if i != 0xFF:
+                        item_shops[i].append((p, slot))
+            return item_shops
+        return get_cache(("ShopObject", "item_shops"), build).get(
+            item_index, [])
+
     @property
     def uses_frog_coins(self):
         return self.get_bit("frog_coins") or self.get_bit("frog_coins_limited")
 
     @property
     def rank(self):
-        maxprice = max([PriceObject.get(i).price for i in self.items])
+        maxprice = max([PriceObject.get(i).price for i in set(self.items)])
         if self.uses_frog_coins:
             maxprice += 2000
         return maxprice
@@ -1211,89 +1484,176 @@ class ShopObject(TableObject):
         return s.strip()
 
     @classmethod
-    def full_randomize(cls):
-        # fix debug bombs before this
-        if hasattr(cls, "after_order"):
-            for cls2 in cls.after_order:
-                if not (hasattr(cls2, "randomized") and cls2.randomized):
-                    raise Exception("Randomize order violated.")
-        cls.randomized = True
+    def get_special_conditions(cls):
+        m = ItemObject.get_mask
+        tonic_mask = m("consumable") & (
+            (~m("misc_attack_1245") & ~m("status_nullification")) | m("all"))
+        return {
+            0: m("consumable") | (
+                m("equipment") & (m("mario") | m("mallow"))),
+            1: m("consumable"),
+            2: m("equipment") & (m("mario") | m("geno") | m("mallow")),
+            4: m("consumable") | (
+                m("equipment") & (m("mario") | m("geno") | m("mallow"))),
+            8: tonic_mask,
+            12: tonic_mask & ~m("reuseable"),
+            13: m("weapon"),
+            14: m("armor"),
+            15: m("accessory"),
+            16: m("consumable"),
+            18: m("consumable"),
+            19: m("equipment"),
+            20: tonic_mask,
+            24: m("consumable"),
+            }
 
-        assignments = {}
+    @classmethod
+    def get_frog_candidates(cls):
+        m = ItemObject.get_mask
+        frog_mask = (m("consumable") | m("accessory")) & ~m("banned")
+        return [i for i in ItemObject.every if i.price and
+                ((i.rare and not i.banned) or frog_mask & (1 << i.index))]
 
-        # phase 1: frog coin shops
-        frog_candidates = [i for i in ItemObject.every if i.price and
-            (i.rare or i.is_consumable or i.is_accessory) and not i.banned]
+    @classmethod
+    def get_stocked_shops(cls):
+        return [p for p in range(25) if p not in cls.juice_bar_partial +
+                [cls.disciple_shop, cls.frog_coin_emporium]]
+
+    @classmethod
+    def get_minimum_stock(cls, p):
+        # the juice bar's partial menus are drawn from shop 12
+        return len(cls.juice_bar_partial) + 1 if p == 12 else 1
+
+    @classmethod
+    def count_stock(cls, items, mask):
+        if mask is None:
+            return len(items)
+        return len([i for i in items if mask & (1 << i.index)])
+
+    @classmethod
+    def check_feasibility(cls):
+        # regular shops stock every unbanned item that isn't rare or a frog
+        # coin candidate, plus whichever frog coin candidates the frog coin
+        # shops leave over
+        problems = []
+        frog_candidates = cls.get_frog_candidates()
+        spare = len(frog_candidates) - cls.num_frog_items
+        if spare < 0:
+            problems.append("not enough frog coin items")
+        frog_set = set(frog_candidates)
+        others = [i for i in ItemObject.every if i not in frog_set
+                  and not i.banned and not i.rare]
+        special_conditions = cls.get_special_conditions()
+        for p in cls.get_stocked_shops():
+            mask = special_conditions.get(p)
+            count = cls.count_stock(others, mask) + min(
+                cls.count_stock(frog_candidates, mask), max(spare, 0))
+            if count < cls.get_minimum_stock(p):
+                problems.append("not enough items for shop %x" % p)
+        if problems:
+            raise Exception("Shops cannot be randomized: %s."
+                            % ", ".join(problems))
+
+    @classmethod
+    def choose_frog_items(cls, rng):
+        assignments = {}
+        disciple_shop = cls.disciple_shop
+        frog_coin_emporium = cls.frog_coin_emporium
+        frog_candidates = cls.get_frog_candidates()
         frog_not_rare = [i for i in frog_candidates if not i.rare]
-        unfrog = random.randint(
-            random.randint(0, len(frog_not_rare)), len(frog_not_rare))
-        unfrog = random.sample(frog_not_rare, unfrog)
-        for i in sorted(unfrog, key=lambda i2: i2.index):
-            frog_candidates.remove(i)
-        frog_chosen = random.sample(frog_candidates, 25)
-        disciple_shop = 3
-        frog_coin_emporium = 6
+        max_unfrog = min(len(frog_not_rare),
+                         len(frog_candidates) - cls.num_frog_items)
+        unfrog = nested_randint(rng, (0, max_unfrog), max_unfrog)
+        unfrog = set(rng.sample(frog_not_rare, unfrog))
+        frog_candidates = [i for i in frog_candidates if i not in unfrog]
+        frog_chosen = rng.sample(frog_candidates, cls.num_frog_items)
         one_only = [i for i in frog_chosen if
             (i.is_equipment and bin(i.equippable).count("1") == 1) or
             (i.is_consumable and i.reuseable)]
         num_choose = min(10, len(one_only))
-        num_choose = random.randint(random.randint(0, num_choose), num_choose)
+        num_choose = nested_randint(rng, (0, num_choose), num_choose)
         num_choose = min(num_choose, len(one_only))
-        chosen = random.sample(one_only, num_choose)
-        choose_again = [i for i in frog_chosen if i not in chosen and (
+        chosen = rng.sample(one_only, num_choose)
+        one_only, chosen_set = set(one_only), set(chosen)
+        choose_again = [i for i in frog_chosen if i not in chosen_set and (
             i in one_only or i.is_equipment)]
         num_choose = 10 - len(chosen)
-        num_choose = random.randint(random.randint(0, num_choose), num_choose)
+        num_choose = nested_randint(rng, (0, num_choose), num_choose)
         num_choose = min(num_choose, len(choose_again))
         if num_choose and choose_again:
-            chosen += random.sample(choose_again, num_choose)
+            chosen += rng.sample(choose_again, num_choose)
         num_choose = 10 - len(chosen)
+        chosen_set = set(chosen)
         if num_choose:
-            choose_again = [i for i in frog_chosen if i not in chosen]
-            random.shuffle(choose_again)
+            choose_again = [i for i in frog_chosen if i not in chosen_set]
+            rng.shuffle(choose_again)
             chosen += choose_again[:num_choose]
+            chosen_set = set(chosen)
         assert len(chosen) == 10
         assignments[disciple_shop] = chosen
         assignments[frog_coin_emporium] = [
-            i for i in frog_chosen if i not in chosen]
+            i for i in frog_chosen if i not in chosen_set]
+        return frog_candidates, frog_chosen, assignments
 
-        # phase 2: non-frog coin shops
-        carryover = [i for i in frog_candidates if
-                     i not in assignments[disciple_shop] and
-                     i not in assignments[frog_coin_emporium]]
-        random.shuffle(carryover)
-        num_choose = random.randint(0, random.randint(0, len(carryover)))
-        carryover = carryover[:num_choose]
+    @classmethod
+    def get_shop_items(cls, carryover, frog_assigned):
         shop_items = carryover + [i for i in ItemObject.every if
-                i not in assignments[disciple_shop] and
-                i not in assignments[frog_coin_emporium] and
-                not i.banned and not i.rare]
-        shop_items = sorted(set(shop_items), key=lambda i: i.rank)
-        juice_bar_partial = [9, 10, 11]  # full: 12
-        special_conditions = {
-            0: lambda i: i.is_consumable or (
-                i.is_equipment and i.equippable & 0b10001),
-            1: lambda i: i.is_consumable,
-            2: lambda i: i.is_equipment and i.equippable & 0b11001,
-            4: lambda i: i.is_consumable or (
-                i.is_equipment and i.equippable & 0b11001),
-            8: lambda i: i.is_consumable and (
-                (i.misc_attack not in [1, 2, 4, 5] and not
-                    i.get_bit("status_nullification")) or i.get_bit("all")),
-            12: lambda i: special_conditions[8](i) and not i.reuseable,
-            13: lambda i: i.is_weapon,
-            14: lambda i: i.is_armor,
-            15: lambda i: i.is_accessory,
-            16: lambda i: i.is_consumable,
-            18: lambda i: i.is_consumable,
-            19: lambda i: i.is_equipment,
-            20: lambda i: special_conditions[8](i),
-            24: lambda i: i.is_consumable,
-            }
+                i not in frog_assigned and not i.banned and not i.rare]
+        # all later pools are filtered from this, so they stay rank ordered
+        return sorted(set(shop_items), key=lambda i: i.rank)
+
+    @classmethod
+    def get_short_shops(cls, shop_items, special_conditions):
+        return [p for p in cls.get_stocked_shops()
+                if cls.count_stock(shop_items, special_conditions.get(p))
+                < cls.get_minimum_stock(p)]
+
+    @classmethod
+    def choose_shop_items(cls, rng, frog_candidates, frog_assigned,
+                          special_conditions):
+        # returns None if the frog coin shops took too much; otherwise the
+        # carryover is redrawn until every shop can be stocked, and all of
+        # it is carried over if that keeps failing
+        leftover = [i for i in frog_candidates if i not in frog_assigned]
+        shop_items = cls.get_shop_items(leftover, frog_assigned)
+        if cls.get_short_shops(shop_items, special_conditions):
+            return None
+        for _ in xrange(cls.max_backtracks):
+            carryover = list(leftover)
+            rng.shuffle(carryover)
+            num_choose = nested_randint(rng, 0, (0, len(carryover)))
+            items = cls.get_shop_items(carryover[:num_choose], frog_assigned)
+            if not cls.get_short_shops(items, special_conditions):
+                return items
+            count_event("shop_carryover_backtrack")
+        return shop_items
+
+    @classmethod
+    def generate_assignments(cls):
+        rng = get_stream("ShopObject")
+        special_conditions = cls.get_special_conditions()
+
+        # phase 1: frog coin shops, chosen again if they leave a regular
+        # shop without enough items
+        for _ in xrange(cls.max_backtracks):
+            frog_candidates, frog_chosen, assignments = (
+                cls.choose_frog_items(rng))
+            frog_assigned = set(frog_chosen)
+            shop_items = cls.choose_shop_items(
+                rng, frog_candidates, frog_assigned, special_conditions)
+            if shop_items is not None:
+                break
+            count_event("shop_frog_backtrack")
+        else:
+            raise Exception("Unable to find a valid shop assignment.")
+
+        # phase 2: non-frog coin shops
+        juice_bar_partial = cls.juice_bar_partial  # full: 12
+        m = ItemObject.get_mask
+        repeatable_mask = (m("consumable") & ~m("reuseable") & ~m("all") & (
+            m("misc_attack_124") | m("status_nullification")))
         done_already = set([])
-        for p in range(25):
-            if p in juice_bar_partial + [disciple_shop, frog_coin_emporium]:
-                continue
+        for p in cls.get_stocked_shops():
             shop = ShopObject.get(p)
             if p == 12:
                 num_items = 15
@@ -1303,38 +1663,30 @@ class ShopObject(TableObject):
             valid_items = list(shop_items)
             if p in special_conditions:
                 valid_items = [i for i in valid_items
-                               if special_conditions[p](i)]
+                               if special_conditions[p] & (1 << i.index)]
             temp = [i for i in valid_items if i not in done_already or
-                    (i.is_consumable and not i.reuseable and not i.rare
-                        and not i.get_bit("all")
-                        and (i.misc_attack in [1, 2, 4] or
-                             i.get_bit("status_nullification")))]
+                    (repeatable_mask & (1 << i.index) and not i.rare)]
             if temp and p not in [12, 13, 14, 20]:
                 valid_items = temp
-                extras = [i for i in valid_items if i not in temp]
-                extras = random.sample(extras,
-                    random.randint(0, len(extras)))
-                valid_items = sorted(set(valid_items + extras),
-                                     key=lambda i: i.rank)
             assert valid_items
             num_items = min(num_items, len(valid_items))
             if p != 20 and len(valid_items) > num_items:
-                valid_items = valid_items[:random.randint(
-                    num_items, random.randint(num_items, len(valid_items)))]
+                valid_items = valid_items[:nested_randint(
+                    rng, num_items, (num_items, len(valid_items)))]
                 consumables = [i for i in valid_items if i.is_consumable]
-                others = [i for i in valid_items if i not in consumables]
+                others = [i for i in valid_items if not i.is_consumable]
                 if consumables and others and num_items >= 4:
-                    num_con = (random.randint(0, num_items) +
-                               random.randint(0, num_items)) / 2
+                    num_con = (rng.randint(0, num_items) +
+                               rng.randint(0, num_items)) / 2
                     num_con = max(num_con, num_items-num_con)
                     num_con = min(num_con, num_items-2)
                     num_oth = num_items-num_con
                     num_con = min(num_con, len(consumables))
                     num_oth = min(num_oth, len(others))
-                    valid_items = (random.sample(consumables, num_con) +
-                                   random.sample(others, num_oth))
+                    valid_items = (rng.sample(consumables, num_con) +
+                                   rng.sample(others, num_oth))
                     num_items = num_con + num_oth
-            chosen_items = random.sample(valid_items, num_items)
+            chosen_items = rng.sample(valid_items, num_items)
             assignments[p] = chosen_items
             for i in chosen_items:
                 done_already.add(i)
@@ -1345,12 +1697,28 @@ class ShopObject(TableObject):
             previous_items = assignments[p+1]
             minimum = n
             maximum = len(previous_items)-1
+            assert maximum >= minimum
             average = (minimum + maximum) / 2
-            num_items = random.randint(
-                random.randint(minimum, average), maximum)
-            chosen_items = random.sample(previous_items, num_items)
+            num_items = nested_randint(rng, (minimum, average), maximum)
+            chosen_items = rng.sample(previous_items, num_items)
             assignments[p] = chosen_items
 
+        return assignments
+
+    @classmethod
+    def full_randomize(cls):
+        # fix debug bombs before this
+        if hasattr(cls, "after_order"):
+            for cls2 in cls.after_order:
+                if not (hasattr(cls2, "randomized") and cls2.randomized):
+                    raise Exception("Randomize order violated.")
+        cls.randomized = True
+
+        cls.check_feasibility()
+        assignments = cls.generate_assignments()
+        disciple_shop = cls.disciple_shop
+        frog_coin_emporium = cls.frog_coin_emporium
+
         # phase 3: repricing
         repriced = set([])
         for p, items in assignments.items():
@@ -1369,7 +1737,7 @@ class ShopObject(TableObject):
                 repriced.add(item)
         for p, items in assignments.items():
             final = [0xFF] * 15
-            items = sorted(items, key=lambda i: ITEM_ORDER.index(i.index))
+            items = sorted(items, key=lambda i: ITEM_ORDER_INDEX[i.index])
             final[:len(items)] = [i.index for i in items]
             ShopObject.get(p).items = final
 
@@ -1377,17 +1745,11 @@ class ShopObject(TableObject):
 
 
     def cleanup(self):
-        frog_items = set([i.index for i in ItemObject.every
-                          if i.is_frog_coin_item])
-        for p in ShopObject.every:
-            for i in p.items:
-                if i == 0xFF:
-                    continue
-                i = ItemObject.get(i)
-                assert 1 <= i.price <= 999
-            if p.index in [3, 6]:
-                continue
-            assert not set(p.items) & frog_items
+        items = [ItemObject.get(i) for i in self.items if i != 0xFF]
+        for i in items:
+            assert 1 <= i.price <= 999
+        if self.index not in [3, 6]:
+            assert not any([i.is_frog_coin_item for i in items])
 
 
 class FlowerBonusObject(TableObject):
@@ -1441,20 +1803,117 @@ def randomize_file_select():
     f.close()
 
 
-if __name__ == "__main__":
-    try:
-        print ('You are using the Super Mario RPG "Gentle Beauty and Raw '
-               'Power" randomizer version %s.' % VERSION)
+def get_all_objects():
+    global ALL_OBJECTS
+    if ALL_OBJECTS is None:
         ALL_OBJECTS = [g for g in globals().values()
                        if isinstance(g, type) and issubclass(g, TableObject)
                        and g not in [TableObject]]
-        run_interface(ALL_OBJECTS, snes=True)
-        hexify = lambda x: "{0:0>2}".format("%x" % x)
-        numify = lambda x: "{0: >3}".format(x)
-        minmax = lambda x: (min(x), max(x))
-        clean_and_write(ALL_OBJECTS)
+    return list(ALL_OBJECTS)
+
+
+ALL_OBJECTS = None
+
+
+class Session(object):
+    # what one randomization owns besides the tables: its rom, flags and
+    # seed, random streams and caches. randomtools loads the tables once per
+    # process, so a process runs one session; batch tools use a fresh worker
+    # per seed. the session stays current after it finishes, so tools can
+    # still read its tables
+    current = None
+
+    def __init__(self, sourcefile=None, flags=None, seed=None):
+        self.sourcefile, self.flags, self.seed = sourcefile, flags, seed
+        self.objects = get_all_objects()
+        self.streams = {}
+        self.caches = {}
+        self.outfile = None
+
+    def get_stream(self, name):
+        # one generator per name, so a class's draws don't depend on how
+        # many numbers other classes used before it
+        if name not in self.streams:
+            if self.seed is None:
+                raise Exception("Random streams have not been seeded.")
+            self.streams[name] = make_stream(self.seed, name)
+        return self.streams[name]
+
+    def get_cache(self, key, build):
+        if key not in self.caches:
+            self.caches[key] = build()
+        return self.caches[key]
+
+    def load(self):
+        # randomtools only reads its arguments from the command line, so
+        # they are put there for the call and taken away after it
+        if Session.current is not None:
+            raise Exception("The tables of this process are already loaded.")
+        Session.current = self
+        saved = list(argv)
+        if self.sourcefile is not None:
+            argv[1:] = [self.sourcefile, self.flags, str(self.seed)]
+        try:
+            with profile_phase("interface", "load"):
+                run_interface(self.objects, snes=True)
+        finally:
+            argv[:] = saved
+        self.seed = get_seed()
+
+    def run(self):
+        self.load()
+        record_digests("load", self.objects, get_global_label())
+        with profile_phase("interface", "clean_and_write"):
+            clean_and_write(self.objects)
+        record_digests("write", self.objects, get_global_label())
         randomize_file_select()
         rewrite_snes_meta("SMRPG-R", VERSION, megabits=32, lorom=True)
+        self.outfile = get_outfile()
+        return self.outfile
+
+
+def get_session():
+    if Session.current is None:
+        raise Exception("No rom has been loaded.")
+    return Session.current
+
+
+def get_stream(name):
+    return get_session().get_stream(name)
+
+
+def get_cache(key, build):
+    return get_session().get_cache(key, build)
+
+
+def clear_cache(key):
+    # tables read outside a session have nothing cached yet
+    if Session.current is not None:
+        Session.current.caches.pop(key, None)
+
+
+def randomize_rom(sourcefile=None, flags=None, seed=None):
+    return Session(sourcefile, flags, seed).run()
+
+if __name__ == "__main__":
+    try:
+        print ('You are using the Super Mario RPG "Gentle Beauty and Raw '
+               'Power" randomizer version %s.' % VERSION)
+        # set SMRPG_PROFILE to a filename to get a JSON timing report
+        profile_filename = environ.get("SMRPG_PROFILE")
+        if profile_filename:
+            enable_profiling(get_all_objects())
+        # set SMRPG_SPOILER to a filename to get a JSON Lines spoiler
+        spoiler_filename = environ.get("SMRPG_SPOILER")
+        if spoiler_filename:
+            enable_change_tracking(get_all_objects())
+        randomize_rom()
+        if profile_filename:
+            write_report(profile_filename, seed=get_seed(),
+                         flags=get_flags(), version=VERSION)
+        if spoiler_filename:
+            write_spoiler(spoiler_filename, get_all_objects(),
+                          get_sourcefile())
         finish_interface()
     except Exception, e:
         print "ERROR: %s" % e
@@ -0,0 +1,163 @@
+from functools import partial
+from os import getcwd, getuid, path
+from snapshot import load_snapshot
+from spoiler import enable_change_tracking, write_spoiler
+from tempfile import gettempdir
+import argparse
+import json
+import os
+import signal
+import socket
+import sys
+
+
+SOCKET_FILENAME = path.join(gettempdir(), "smrpg_randomizer_%s.sock" % getuid())
+REQUEST_TIMEOUT = 10
+
+
+def handle(connection, request, snapshot, run_seed):
+    # runs in a forked child, so every request starts from the same warm
+    # and untouched parent
+    extract, prepare = keep_rom, None
+    if request.get("spoiler"):
+        extract = partial(keep_spoiler, request["sourcefile"], snapshot,
+                          request["output_dir"])
+        prepare = track_changes
+    seed, result, error = run_seed((
+        request["sourcefile"], request["flags"], request["seed"],
+        extract, request["output_dir"], prepare))
+    if error is None:
+        response = {"seed": seed, "outfile": result[1]}
+        if result[0] is not None:
+            response["spoiler"] = result[0]
+    else:
+        response = {"seed": seed, "error": error}
+    connection.sendall(json.dumps(response) + "\n")
+    connection.close()
+
+
+def keep_rom(randomizer, seed):
+    return None, True
+
+
+def track_changes(randomizer):
+    enable_change_tracking(randomizer.get_all_objects())
+
+
+def keep_spoiler(sourcefile, snapshot, output_dir, randomizer, seed):
+    filename = path.join(output_dir, "%s.jsonl.gz" % path.basename(
+        randomizer.get_outfile()))
+    write_spoiler(filename, randomizer.get_all_objects(), sourcefile,
+                  snapshot=snapshot)
+    return filename, True
+
+
+def get_snapshot(snapshots, sourcefile):
+    # mapped and indexed in the parent, so the children share its pages
+    mtime = path.getmtime(sourcefile)
+    if sourcefile not in snapshots or snapshots[sourcefile][0] != mtime:
+        if sourcefile in snapshots:
+            snapshots.pop(sourcefile)[1].close()
+        snapshot = load_snapshot(sourcefile)
+        for objname in snapshot.directory["tables"]:
+            snapshot.get_table(objname)
+        snapshots[sourcefile] = (mtime, snapshot)
+    return snapshots[sourcefile][1]
+
+
+def serve(socket_filename):
+    # the imports, module setup and table discovery happen once, here
+    from batch import run_seed
+    import randomizer
+    randomizer.get_all_objects()
+    snapshots = {}
+    if path.exists(socket_filename):
+        os.remove(socket_filename)
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    # the socket is created private, not made private after the fact
+    umask = os.umask(0177)
+    try:
+        server.bind(socket_filename)
+    finally:
+        os.umask(umask)
+    server.listen(8)
+    signal.signal(signal.SIGCHLD, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, lambda *args: sys.exit(0))
+    print "Listening on %s" % socket_filename
+    sys.stdout.flush()
+    try:
+        while True:
+            connection, _ = server.accept()
+            try:
+                connection.settimeout(REQUEST_TIMEOUT)
+                request = json.loads(connection.makefile("rb").readline())
+                connection.settimeout(None)
+                snapshot = None
+                if request.get("spoiler"):
+                    snapshot = get_snapshot(snapshots, request["sourcefile"])
+            except Exception, e:
+                try:
+                    connection.sendall(json.dumps({"error": str(e)}) + "\n")
+                except socket.error:
+                    pass
+                connection.close()
+                continue
+            if os.fork() == 0:
+                server.close()
+                signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+                signal.signal(signal.SIGTERM, signal.SIG_DFL)
+                try:
+                    handle(connection, request, snapshot, run_seed)
+                finally:
+                    os._exit(0)
+            connection.close()
+    finally:
+        server.close()
+        os.remove(socket_filename)
+
+
+def request(socket_filename, sourcefile, flags, seed, output_dir,
+            spoiler=False):
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        client.connect(socket_filename)
+    except socket.error:
+        raise Exception("No resident randomizer at %s; start one with "
+                        "\"resident.py serve\"." % socket_filename)
+    client.sendall(json.dumps({
+        "sourcefile": path.abspath(sourcefile), "flags": flags,
+        "seed": seed, "output_dir": path.abspath(output_dir),
+        "spoiler": spoiler}) + "\n")
+    line = client.makefile("rb").readline()
+    client.close()
+    if not line:
+        raise Exception("The resident randomizer closed the connection.")
+    return json.loads(line)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Keep a randomizer process warm and randomize roms "
+                    "through it.")
+    parser.add_argument("--socket", default=SOCKET_FILENAME)
+    subparsers = parser.add_subparsers(dest="command")
+    subparsers.add_parser("serve")
+    run = subparsers.add_parser("run")
+    run.add_argument("sourcefile")
+    run.add_argument("flags")
+    run.add_argument("seed", type=int)
+    run.add_argument("--output-dir", default=getcwd())
+    run.add_argument("--spoiler", action="store_true",
+                     help="also write a spoiler next to the output rom")
+    args = parser.parse_args()
+    if args.command == "serve":
+        serve(args.socket)
+    else:
+        response = request(args.socket, args.sourcefile, args.flags,
+                           args.seed, args.output_dir, spoiler=args.spoiler)
+        if "error" in response:
+            print >>sys.stderr, response["error"]
+            sys.exit(1)
+        print response["outfile"]
+        if "spoiler" in response:
+            print response["spoiler"]
@@ -0,0 +1,78 @@
+from hashlib import md5
+from random import Random
+
+
+TABLES = {}
+
+
+class AliasTable(object):
+    # Vose's alias method: linear setup, then every draw is one random
+    # number and one lookup no matter how many values there are
+    def __init__(self, values, weights):
+        assert len(values) == len(weights) and values
+        total = float(sum(weights))
+        n = len(values)
+        scaled = [w * n / total for w in weights]
+        self.values = list(values)
+        self.probabilities = [1.0] * n
+        self.aliases = range(n)
+        small = [i for (i, p) in enumerate(scaled) if p < 1]
+        large = [i for (i, p) in enumerate(scaled) if p >= 1]
+        while small and large:
+            s, l = small.pop(), large.pop()
+            self.probabilities[s] = scaled[s]
+            self.aliases[s] = l
+            scaled[l] -= 1 - scaled[s]
+            if scaled[l] < 1:
+                small.append(l)
+            else:
+                large.append(l)
+
+    def draw(self, rng):
+        u = rng.random() * len(self.values)
+        i = int(u)
+        if u - i < self.probabilities[i]:
+            return self.values[i]
+        return self.values[self.aliases[i]]
+
+
+def get_randint_distribution(low, high):
+    # {value: probability} of random.randint(low, high), where low and high
+    # are ints or (low, high) pairs standing for nested randint calls
+    lows = (get_randint_distribution(*low) if isinstance(low, tuple)
+            else {low: 1.0})
+    highs = (get_randint_distribution(*high) if isinstance(high, tuple)
+             else {high: 1.0})
+    if max(lows) > min(highs):
+        raise ValueError("empty range for randint(%s, %s)" % (low, high))
+    top = max(highs)
+    distribution = {}
+    for l, pl in lows.items():
+        # every high value h spreads its probability evenly over l..h
+        share = 0.0
+        for v in xrange(top, l-1, -1):
+            if v in highs:
+                share += highs[v] / (v - l + 1)
+            if share:
+                distribution[v] = distribution.get(v, 0) + (pl * share)
+    return distribution
+
+
+def get_randint_table(low, high):
+    key = (low, high)
+    if key not in TABLES:
+        distribution = sorted(get_randint_distribution(low, high).items())
+        TABLES[key] = AliasTable([v for (v, _) in distribution],
+                                 [p for (_, p) in distribution])
+    return TABLES[key]
+
+
+def nested_randint(rng, low, high):
+    # e.g. nested_randint(rng, 0, (0, 8)) is distributed like
+    # random.randint(0, random.randint(0, 8)), but costs one draw
+    return get_randint_table(low, high).draw(rng)
+
+
+def make_stream(seed, name):
+    # the same seed and name always give the same sequence
+    return Random(int(md5("%s:%s" % (seed, name)).hexdigest(), 0x10))
@@ -0,0 +1,110 @@
+from batch import run_seeds
+from functools import partial
+from os import path
+import argparse
+import sys
+
+
+# name: (arguments, flag that randomizes the tables it reads)
+PREDICATES = {
+    "shop": (["shop", "item"], "p"),
+    "learn": (["character", "spell", "level"], "z"),
+    "packrank": (["pack", "rank"], "f"),
+    "drop": (["monster", "item"], "d"),
+    }
+
+
+def shop_sells(r, shop, item):
+    return item in r.ShopObject.get(shop).items
+
+
+def learns_by(r, character, spell, level):
+    if r.CharacterObject.get(character).known_spells & (1 << spell):
+        return True
+    return any([l.spell == spell for l in
+                r.LearnObject.get_character_rows(character)
+                if l.level <= level])
+
+
+def pack_rank_at_most(r, pack, rank):
+    return all([f.rank <= rank for f in r.PackObject.get(pack).formations])
+
+
+def drops(r, monster, item):
+    reward = r.MonsterRewardObject.get(monster)
+    return item in [reward.drop, reward.rare_drop]
+
+
+CHECKS = {
+    "shop": shop_sells,
+    "learn": learns_by,
+    "packrank": pack_rank_at_most,
+    "drop": drops,
+    }
+
+
+def parse_predicate(text):
+    # e.g. "shop:6:5e", numbers are hexadecimal
+    parts = text.split(":")
+    name, values = parts[0], parts[1:]
+    if name not in PREDICATES:
+        raise ValueError("Unknown predicate: %s" % name)
+    arguments, _ = PREDICATES[name]
+    if len(values) != len(arguments):
+        raise ValueError("%s takes %s" % (name, ":".join(arguments)))
+    return (name, tuple([int(v, 0x10) for v in values]))
+
+
+def check_predicates(predicates, randomizer, seed):
+    matched = all([CHECKS[name](randomizer, *values)
+                   for (name, values) in predicates])
+    return matched, matched
+
+
+def search(sourcefile, flags, predicates, seeds, num_matches,
+           output_dir=None, processes=None):
+    extract = partial(check_predicates, predicates)
+    matches = []
+    results = run_seeds(sourcefile, flags, seeds, extract,
+                        output_dir=output_dir, processes=processes)
+    for seed, result, error in results:
+        if error is not None:
+            print >>sys.stderr, "Seed %s failed:\n%s" % (seed, error)
+            continue
+        if result:
+            matches.append(seed)
+            print seed
+            sys.stdout.flush()
+            if len(matches) >= num_matches:
+                results.close()
+                break
+    return matches
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Search for seeds whose randomized tables match all of "
+                    "the given predicates. Predicates: %s." % ", ".join(
+                        ["%s:%s" % (name, ":".join(arguments))
+                         for (name, (arguments, _))
+                         in sorted(PREDICATES.items())]))
+    parser.add_argument("sourcefile")
+    parser.add_argument("flags")
+    parser.add_argument("predicates", nargs="+", type=parse_predicate)
+    parser.add_argument("--start", type=int, default=0)
+    parser.add_argument("--count", type=int, default=100000)
+    parser.add_argument("--matches", type=int, default=1)
+    parser.add_argument("--processes", type=int, default=None)
+    parser.add_argument("--output-dir", default=None,
+                        help="keep the roms of matching seeds here")
+    args = parser.parse_args()
+    for name, _ in args.predicates:
+        flag = PREDICATES[name][1]
+        if flag not in args.flags:
+            print >>sys.stderr, ("Warning: %s is not randomized without "
+                                 "flag %s." % (name, flag))
+    if args.output_dir is not None:
+        args.output_dir = path.abspath(args.output_dir)
+    search(path.abspath(args.sourcefile), args.flags, args.predicates,
+           xrange(args.start, args.start + args.count), args.matches,
+           output_dir=args.output_dir, processes=args.processes)
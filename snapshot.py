@@ -0,0 +1,211 @@
+from hashlib import md5
+from mmap import mmap, ACCESS_READ
+from os import path, rename, makedirs
+from struct import calcsize, pack, unpack_from
+from tablespecs import TABLES_DIR, get_specs, get_table_list
+from tempfile import mkstemp
+import argparse
+import json
+import os
+
+
+MAGIC = "SMRPGSNP"
+FORMAT_VERSION = 1
+HEADER = "<8sII"
+SNAPSHOT_DIR = path.join(path.dirname(path.abspath(__file__)), "snapshots")
+TYPECODES = {1: "B", 2: "H", 3: "I", 4: "I"}
+
+
+def get_label(rom_md5):
+    for line in open(path.join(TABLES_DIR, "master.txt")):
+        parts = line.split()
+        if parts and parts[1] == rom_md5:
+            return parts[0]
+    raise Exception("Unknown rom: %s" % rom_md5)
+
+
+def get_spec_md5(label):
+    # a snapshot goes stale when any table definition changes
+    h = md5()
+    for t in get_table_list(label):
+        h.update(open(path.join(TABLES_DIR, t["tablefile"])).read())
+        h.update("%s %x %s %s" % (t["objname"], t["address"], t["count"],
+                                  t["grouped"]))
+    return h.hexdigest()
+
+
+def read_records(rom, table, width):
+    # raw records, following the pointers of pointer grouped tables
+    address, count = table["address"], table["count"]
+    if table["grouped"] and table["grouped"][0] == "point1":
+        _, base, pointer_size = table["grouped"]
+        records = []
+        for i in xrange(count):
+            pointer = address + (i * pointer_size)
+            offset = base | sum([rom[pointer + n] << (8*n)
+                                 for n in xrange(pointer_size)])
+            records.append(rom[offset:offset + width])
+        return records
+    return [rom[address + (i*width):address + ((i+1)*width)]
+            for i in xrange(count)]
+
+
+def decode_int(data, size):
+    return sum([data[n] << (8*n) for n in xrange(size)])
+
+
+def build_snapshot(romfile, filename=None):
+    # every table is stored as one flat array per field, so a field of
+    # row n is at a fixed offset and nothing has to be parsed to read it
+    rom = bytearray(open(romfile, "rb").read())
+    if len(rom) % 0x8000 == 0x200:
+        rom = rom[0x200:]
+    rom_md5 = md5(rom).hexdigest()
+    label = get_label(rom_md5)
+    if filename is None:
+        filename = get_snapshot_filename(rom_md5)
+    specs = get_specs(label)
+    directory = {"label": label, "rom_md5": rom_md5,
+                 "spec_md5": get_spec_md5(label), "tables": {}}
+    chunks, offset = [], 0
+    for table in get_table_list(label):
+        spec = specs[table["objname"]]
+        width = sum([size for (_, size, _) in spec])
+        records = read_records(rom, table, width)
+        fields, position = [], 0
+        for name, size, fieldtype in spec:
+            values = [r[position:position+size] for r in records]
+            position += size
+            if fieldtype in ("str", "list"):
+                data = "".join([str(v) for v in values])
+                fields.append([name, fieldtype, size, offset])
+            else:
+                typecode = TYPECODES[size]
+                data = pack("<%s%s" % (len(values), typecode),
+                            *[decode_int(v, size) for v in values])
+                fields.append([name, typecode, calcsize(typecode), offset])
+            data += "\x00" * (-len(data) % 8)
+            chunks.append(data)
+            offset += len(data)
+        directory["tables"][table["objname"]] = {"count": len(records),
+                                                 "fields": fields}
+    directory = json.dumps(directory, sort_keys=True)
+    directory += " " * (-(calcsize(HEADER) + len(directory)) % 8)
+    if not path.exists(path.dirname(filename)):
+        makedirs(path.dirname(filename))
+    # written to a temporary file and renamed, so a worker never maps a
+    # partial snapshot
+    handle, tempname = mkstemp(dir=path.dirname(filename))
+    f = os.fdopen(handle, "wb")
+    f.write(pack(HEADER, MAGIC, FORMAT_VERSION, len(directory)))
+    f.write(directory)
+    for data in chunks:
+        f.write(data)
+    f.close()
+    os.chmod(tempname, 0644)
+    rename(tempname, filename)
+    return filename
+
+
+def get_snapshot_filename(rom_md5):
+    return path.join(SNAPSHOT_DIR, "%s.snap" % rom_md5)
+
+
+class Snapshot(object):
+    def __init__(self, filename):
+        f = open(filename, "rb")
+        self.data = mmap(f.fileno(), 0, access=ACCESS_READ)
+        f.close()
+        magic, version, length = unpack_from(HEADER, self.data)
+        if magic != MAGIC or version != FORMAT_VERSION:
+            raise Exception("%s is not a version %s snapshot." % (
+                filename, FORMAT_VERSION))
+        start = calcsize(HEADER)
+        self.directory = json.loads(self.data[start:start + length])
+        self.base = start + length
+        self.tables = {}
+
+    def get_table(self, objname):
+        if objname not in self.tables:
+            self.tables[objname] = SnapshotTable(
+                self, self.directory["tables"][objname])
+        return self.tables[objname]
+
+    def close(self):
+        self.data.close()
+
+
+class SnapshotTable(object):
+    # read-only rows straight from the mapped file
+    def __init__(self, snapshot, entry):
+        self.data, self.base = snapshot.data, snapshot.base
+        self.count = entry["count"]
+        self.fields = dict([(name, (typecode, size, offset))
+                            for (name, typecode, size, offset)
+                            in entry["fields"]])
+        self.field_names = [name for (name, _, _, _) in entry["fields"]]
+
+    def __len__(self):
+        return self.count
+
+    def get(self, index, field):
+        if not 0 <= index < self.count:
+            raise IndexError(index)
+        typecode, size, offset = self.fields[field]
+        start = self.base + offset + (index * size)
+        if typecode == "str":
+            return self.data[start:start + size]
+        if typecode == "list":
+            return list(unpack_from("<%sB" % size, self.data, start))
+        return unpack_from("<" + typecode, self.data, start)[0]
+
+    def get_row(self, index):
+        return dict([(f, self.get(index, f)) for f in self.field_names])
+
+
+class Overlay(object):
+    # copy on write: changed fields are kept here, everything else is read
+    # from the shared snapshot
+    def __init__(self, table):
+        self.table = table
+        self.changes = {}
+
+    def __len__(self):
+        return len(self.table)
+
+    def get(self, index, field):
+        if (index, field) in self.changes:
+            return self.changes[index, field]
+        return self.table.get(index, field)
+
+    def set(self, index, field, value):
+        if value == self.table.get(index, field):
+            self.changes.pop((index, field), None)
+        else:
+            self.changes[index, field] = value
+
+
+def load_snapshot(romfile):
+    # builds the snapshot the first time a rom is seen, then maps it
+    rom = open(romfile, "rb").read()
+    if len(rom) % 0x8000 == 0x200:
+        rom = rom[0x200:]
+    rom_md5 = md5(rom).hexdigest()
+    filename = get_snapshot_filename(rom_md5)
+    if path.exists(filename):
+        snapshot = Snapshot(filename)
+        label = snapshot.directory["label"]
+        if snapshot.directory["spec_md5"] == get_spec_md5(label):
+            return snapshot
+        snapshot.close()
+    return Snapshot(build_snapshot(romfile, filename))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Save the vanilla tables of a rom as a snapshot that "
+                    "later runs and tools can memory map.")
+    parser.add_argument("sourcefile")
+    parser.add_argument("--output", default=None)
+    args = parser.parse_args()
+    print build_snapshot(args.sourcefile, args.output)
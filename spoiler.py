@@ -0,0 +1,94 @@
+from os import path
+from snapshot import load_snapshot
+from text import decode
+import argparse
+import gzip
+import json
+
+
+def track_class(cls):
+    # cls._dirty is index -> names of the fields written with a new value
+    original = cls.__setattr__
+
+    def __setattr__(self, attr, value):
+        # the first assignment is the table being read, not a change
+        if (not attr.startswith("_") and attr in self.__dict__
+                and self.__dict__[attr] != value):
+            type(self)._dirty.setdefault(self.index, set()).add(attr)
+        original(self, attr, value)
+
+    cls.__setattr__ = __setattr__
+    cls._dirty = {}
+
+
+def enable_change_tracking(objects):
+    # must come before the tables are read
+    for o in objects:
+        if "_dirty" in o.__dict__:
+            o._dirty = {}
+        else:
+            track_class(o)
+
+
+def iter_changes(objects, sourcefile, snapshot=None):
+    # only dirty rows are visited and only their dirty fields are read from
+    # the snapshot, which isn't loaded at all if nothing changed
+    for cls in sorted(objects, key=lambda o: o.__name__):
+        dirty = cls.__dict__.get("_dirty")
+        if not dirty:
+            continue
+        if snapshot is None:
+            snapshot = load_snapshot(sourcefile)
+        if cls.__name__ not in snapshot.directory["tables"]:
+            continue
+        label = snapshot.directory["label"]
+        table = snapshot.get_table(cls.__name__)
+        for index in sorted(dirty):
+            if index >= len(table):
+                continue
+            obj = cls.get(index)
+            changes = {}
+            for attr in sorted(dirty[index]):
+                if attr not in table.fields:
+                    continue
+                vanilla = table.get(index, attr)
+                value = getattr(obj, attr)
+                if value == vanilla:
+                    continue
+                if table.fields[attr][0] == "str":
+                    vanilla = decode(vanilla, label)
+                    value = decode(value, label)
+                changes[attr] = [vanilla, value]
+            if changes:
+                yield {"table": cls.__name__, "index": index,
+                       "changes": changes}
+
+
+def write_spoiler(filename, objects, sourcefile, snapshot=None,
+                  compress=None):
+    if compress is None:
+        compress = filename.endswith(".gz")
+    f = gzip.open(filename, "wb") if compress else open(filename, "w")
+    try:
+        for change in iter_changes(objects, sourcefile, snapshot):
+            f.write(json.dumps(change, sort_keys=True) + "\n")
+    finally:
+        f.close()
+
+
+if __name__ == "__main__":
+    import randomizer
+    parser = argparse.ArgumentParser(
+        description="Randomize a rom and write a JSON Lines spoiler of "
+                    "every field that differs from the vanilla rom.")
+    parser.add_argument("sourcefile")
+    parser.add_argument("flags")
+    parser.add_argument("seed", type=int)
+    parser.add_argument("--output", default=None,
+                        help="defaults to the output rom name + .jsonl.gz")
+    args = parser.parse_args()
+    sourcefile = path.abspath(args.sourcefile)
+    objects = randomizer.get_all_objects()
+    enable_change_tracking(objects)
+    outfile = randomizer.randomize_rom(sourcefile, args.flags, args.seed)
+    write_spoiler(args.output or "%s.jsonl.gz" % outfile, objects, sourcefile)
@@ -0,0 +1,163 @@
+from array import array
+from batch import run_seeds
+from math import log, exp
+from os import path
+import argparse
+import json
+import sys
+
+
+QUANTILES = [0.01, 0.05, 0.25, 0.5, 0.75, 0.95, 0.99]
+
+
+class Histogram(object):
+    # fixed bins, so memory doesn't grow with the number of seeds
+    def __init__(self, low, high, bins=256, logscale=False):
+        self.low, self.high, self.logscale = low, high, logscale
+        self.counts = array("L", [0] * bins)
+        self.total, self.sum = 0, 0.0
+        self.minimum, self.maximum = None, None
+
+    def scale(self, value):
+        if self.logscale:
+            return log(max(value, self.low) + 1)
+        return value
+
+    def unscale(self, value):
+        if self.logscale:
+            return exp(value) - 1
+        return value
+
+    def add(self, value):
+        lower, upper = self.scale(self.low), self.scale(self.high)
+        position = (self.scale(value) - lower) / float(upper - lower)
+        index = int(position * len(self.counts))
+        index = min(max(index, 0), len(self.counts)-1)
+        self.counts[index] += 1
+        self.total += 1
+        self.sum += value
+        if self.minimum is None or value < self.minimum:
+            self.minimum = value
+        if self.maximum is None or value > self.maximum:
+            self.maximum = value
+
+    def quantile(self, q):
+        if not self.total:
+            return None
+        lower, upper = self.scale(self.low), self.scale(self.high)
+        width = (upper - lower) / float(len(self.counts))
+        target = q * self.total
+        seen = 0
+        for index, count in enumerate(self.counts):
+            if count and seen + count >= target:
+                fraction = (target - seen) / float(count)
+                value = self.unscale(lower + ((index + fraction) * width))
+                return min(max(value, self.minimum), self.maximum)
+            seen += count
+        return self.maximum
+
+    def summary(self):
+        if not self.total:
+            return {"count": 0}
+        return {"count": self.total, "mean": self.sum / self.total,
+                "min": self.minimum, "max": self.maximum,
+                "quantiles": dict([("%s" % q, self.quantile(q))
+                                   for q in QUANTILES]),
+                "histogram": {"low": self.low, "high": self.high,
+                              "log": self.logscale,
+                              "counts": list(self.counts)}}
+
+
+# metric: (low, high, logscale)
+METRICS = {
+    "monster_hp": (1, 32000, True),
+    "shop_price": (1, 999, True),
+    "frog_coin_price": (1, 999, True),
+    "formation_size": (0, 8, False),
+    "formation_rank": (1, 10000000, True),
+    "pack_rank": (1, 10000000, True),
+    }
+PER_LEVEL = {"xp": (1, 65535, True)}
+PER_CHARACTER = {"spells": (0, 32, False)}
+
+
+def extract_columns(randomizer, seed):
+    r = randomizer
+    columns = {}
+    columns["monster_hp"] = [m.hp for m in r.MonsterObject.every]
+    prices, frog_prices = [], []
+    for p in r.ShopObject.every:
+        for i in p.items:
+            if i == 0xFF:
+                continue
+            if p.uses_frog_coins:
+                frog_prices.append(r.PriceObject.get(i).price)
+            else:
+                prices.append(r.PriceObject.get(i).price)
+    columns["shop_price"] = prices
+    columns["frog_coin_price"] = frog_prices
+    formations = [f for f in r.FormationObject.every if f.enemies_present]
+    columns["formation_size"] = [len(f.enemies) for f in formations]
+    columns["formation_rank"] = [f.rank for f in formations]
+    columns["pack_rank"] = [p.rank for p in r.PackObject.every]
+    for l in r.LevelUpXPObject.every:
+        columns["xp/%s" % (l.index + 2)] = [l.xp]
+    for c in r.CharacterObject.every:
+        known = c.known_spells
+        for l in r.LearnObject.get_character_rows(c.index):
+            if l.spell <= 0x1A:
+                known |= (1 << l.spell)
+        columns["spells/%s" % c.index] = [bin(known).count("1")]
+    return columns, False
+
+
+def get_histogram(histograms, name):
+    if name not in histograms:
+        base = name.split("/")[0]
+        low, high, logscale = (METRICS.get(base) or PER_LEVEL.get(base)
+                               or PER_CHARACTER.get(base))
+        histograms[name] = Histogram(low, high, logscale=logscale)
+    return histograms[name]
+
+
+def sweep(sourcefile, flags, seeds, processes=None):
+    histograms = {}
+    failures = 0
+    for seed, columns, error in run_seeds(sourcefile, flags, seeds,
+                                          extract_columns,
+                                          processes=processes):
+        if error is not None:
+            failures += 1
+            print >>sys.stderr, "Seed %s failed:\n%s" % (seed, error)
+            continue
+        for name, values in columns.items():
+            h = get_histogram(histograms, name)
+            for value in values:
+                h.add(value)
+    return {"flags": flags, "failures": failures,
+            "metrics": dict([(name, h.summary())
+                             for (name, h) in sorted(histograms.items())])}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Randomize many seeds without keeping the roms and "
+                    "summarize the distributions of the randomized tables.")
+    parser.add_argument("sourcefile")
+    parser.add_argument("flags")
+    parser.add_argument("--start", type=int, default=0)
+    parser.add_argument("--count", type=int, default=1000)
+    parser.add_argument("--processes", type=int, default=None)
+    parser.add_argument("--output", default=None,
+                        help="write the JSON report here instead of stdout")
+    args = parser.parse_args()
+    report = sweep(path.abspath(args.sourcefile), args.flags,
+                   xrange(args.start, args.start + args.count),
+                   processes=args.processes)
+    report["seeds"] = [args.start, args.start + args.count]
+    if args.output:
+        f = open(args.output, "w")
+        json.dump(report, f, indent=2, sort_keys=True)
+        f.close()
+    else:
+        print json.dumps(report, indent=2, sort_keys=True)
@@ -0,0 +1,64 @@
+from os import path
+
+
+TABLES_DIR = path.join(path.dirname(path.abspath(__file__)), "tables")
+SPECS = {}
+
+
+def read_table_list(filename="tables_list.txt"):
+    tables = []
+    for line in open(path.join(TABLES_DIR, filename)):
+        line = line.strip()
+        if not line or line.startswith("#"):
+            continue
+        parts = line.split()
+        objname, tablefile, address, count = parts[:4]
+        table = {"objname": objname, "tablefile": tablefile,
+                 "address": int(address, 0x10), "count": int(count),
+                 "grouped": None}
+        if len(parts) > 4:
+            table["grouped"] = (parts[4], int(parts[5], 0x10),
+                                int(parts[6]))
+        tables.append(table)
+    return tables
+
+
+def read_spec(tablefile):
+    fields = []
+    for line in open(path.join(TABLES_DIR, tablefile)):
+        line = line.strip()
+        if not line or line.startswith("#"):
+            continue
+        parts = line.split(",")
+        name = parts[0]
+        if parts[1].startswith("bit:"):
+            fields.append((name, 1, "bit"))
+        elif len(parts) > 2:
+            fields.append((name, int(parts[1]), parts[2]))
+        else:
+            fields.append((name, int(parts[1]), "int"))
+    return fields
+
+
+def get_table_list(label):
+    for line in open(path.join(TABLES_DIR, "master.txt")):
+        parts = line.split()
+        if parts and parts[0] == label:
+            return read_table_list(parts[2])
+    raise Exception("%s is missing from tables/master.txt." % label)
+
+
+def get_specs(label):
+    # objname -> [(field, size, type)], from the label's table list
+    if label not in SPECS:
+        SPECS[label] = dict([(t["objname"], read_spec(t["tablefile"]))
+                             for t in get_table_list(label)])
+    return SPECS[label]
+
+
+def encode_field(value, size, fieldtype):
+    if fieldtype == "str":
+        return value[:size].ljust(size)
+    if fieldtype == "list":
+        return "".join([chr(v & 0xFF) for v in value])
+    return "".join([chr((value >> (8*n)) & 0xFF) for n in xrange(size)])
@@ -0,0 +1,47 @@
+import re
+
+
+TOKEN = re.compile(r"\{[0-9a-f]{2}\}|.", re.DOTALL)
+
+
+def make_decode_table(printable):
+    # bytes without a known character decode to "{xx}" so every name
+    # round trips through encode
+    return [chr(i) if chr(i) in printable and chr(i) not in "{}"
+            else "{%02x}" % i for i in xrange(0x100)]
+
+
+# the NA font matches ascii for plain text, and the icons have no ascii
+# equivalent and are kept as escapes. there is no JP font table yet, so JP
+# text, like any other label without a table, is shown as escapes only
+DECODE_TABLES = {
+    "SMRPG_NA": make_decode_table(map(chr, range(0x20, 0x7f))),
+    }
+# the synthetic benchmark rom is built from the NA table list
+DECODE_TABLES["SMRPG_BENCH"] = DECODE_TABLES["SMRPG_NA"]
+ESCAPE_TABLE = make_decode_table([])
+ENCODE_TABLES = dict([
+    (label, dict([(text, chr(i)) for (i, text) in enumerate(table)]))
+    for (label, table) in DECODE_TABLES.items()])
+ESCAPE_ENCODE_TABLE = {}
+for table in ENCODE_TABLES.values() + [ESCAPE_ENCODE_TABLE]:
+    for i in xrange(0x100):
+        table["{%02x}" % i] = chr(i)
+
+
+def decode(data, label):
+    table = DECODE_TABLES.get(label, ESCAPE_TABLE)
+    return "".join([table[ord(c)] for c in data])
+
+
+def encode(text, label, length=None):
+    table = ENCODE_TABLES.get(label, ESCAPE_ENCODE_TABLE)
+    try:
+        data = "".join([table[t] for t in TOKEN.findall(text)])
+    except KeyError, e:
+        raise Exception("Can't encode %s in %s." % (e, label))
+    if length is not None:
+        if len(data) > length:
+            raise Exception("%s is longer than %s bytes." % (text, length))
+        data = data.ljust(length)
+    return data